@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+# start-up time of the command line: --version, --help and the group level must not import the
+# imaging stack, the participant modules only import the heavy packages when a stage needs them;
+# exits with 1 if a case imports a module it must not (needs python >= 3.7 for -X importtime)
+IMAGING = ('nibabel', 'scipy', 'dipy', 'skimage', 'statsmodels', 'sklearn', 'matplotlib.pyplot',
+           'mpl_toolkits')
+FORBIDDEN = {'version': IMAGING + ('numpy', 'pandas', 'matplotlib'),
+             'help': IMAGING + ('numpy', 'pandas', 'matplotlib'),
+             'group': IMAGING,
+             'participant_imports': ('dipy', 'skimage', 'statsmodels', 'sklearn')}
+CASES = ('version', 'help', 'group', 'participant_imports')
+
+parser = argparse.ArgumentParser(description='diffQC command line start-up time')
+parser.add_argument('--repeat', help='runs per case, the median is reported', type=int, default=5)
+parser.add_argument('--top', help='heaviest top-level imports listed per case', type=int, default=5)
+parser.add_argument('--history', help='JSON lines file the results are appended to',
+                    default='import_time_history.jsonl')
+
+def commands(work_dir):
+    run = [sys.executable, os.path.join(root, 'run.py')]
+    bids_dir = os.path.join(work_dir, 'bids')
+    output_dir = os.path.join(work_dir, 'output')
+    return {'version': run + ['--version'],
+            'help': run + ['--help'],
+            'group': run + [bids_dir, output_dir, 'group', '--skip_bids_validator'],
+            'participant_imports': [sys.executable, '-c', 'import sys; sys.path.insert(0, %r); '
+                                    'from diffqc import pipeline, scheduler'%root]}
+
+def parseImportTime(stderr):
+    # [(module, depth, cumulative seconds)] from the -X importtime report
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(cumulative) / 1e6))
+    return imports
+
+def forbidden(imports, case):
+    return sorted(set(name for (name, _, _) in imports
+                      if any(name == m or name.startswith(m + '.') for m in FORBIDDEN[case])))
+
+def measure(command, repeat):
+    walls = []
+    for i in range(repeat):
+        start = time.time()
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        walls.append(time.time() - start)
+        if process.returncode != 0:
+            raise Exception("failed: " + " ".join(command))
+    # one more run for the import report
+    process = subprocess.run([command[0], '-X', 'importtime'] + command[1:], stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+    return (sorted(walls)[len(walls) // 2], parseImportTime(process.stderr.decode('utf-8')))
+
+def previousRun(history):
+    if not os.path.isfile(history):
+        return None
+    previous = None
+    with open(history) as fp:
+        for line in fp:
+            previous = json.loads(line)
+    return previous
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix='diffqc_import_')
+    synthetic.createDataset(os.path.join(work_dir, 'bids'), 1, matrix=(8, 8, 4), shells=(1000,), dirs=6, b0s=1)
+
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': socket.gethostname(),
+              'python': platform.python_version(), 'cases': {}}
+    previous = previousRun(args.history)
+    failed = False
+    for case, command in sorted(commands(work_dir).items(), key=lambda c: CASES.index(c[0])):
+        (wall, imports) = measure(command, args.repeat)
+        bad = forbidden(imports, case)
+        top = sorted([i for i in imports if i[1] == 0], key=lambda i: -i[2])[:args.top]
+        record['cases'][case] = {'wall_time': wall, 'modules': len(imports), 'forbidden': bad,
+                                 'top': [[name, t] for (name, _, t) in top]}
+
+        change = ''
+        if previous is not None and case in previous['cases'] and previous['cases'][case]['wall_time'] > 0:
+            change = ' (%+.0f%% vs. last)'%(100 * (wall / previous['cases'][case]['wall_time'] - 1))
+        print("%-20s %6.2f s%s, %d modules"%(case, wall, change, len(imports)))
+        for (name, _, t) in top:
+            print("    %-24s %6.3f s"%(name, t))
+        if bad:
+            print("    imports %s"%", ".join(bad))
+            failed = True
+
+    with open(args.history, 'a') as fp:
+        fp.write(json.dumps(record, sort_keys=True) + '\n')
+    shutil.rmtree(work_dir)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(parser.parse_args()))
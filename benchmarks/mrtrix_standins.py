@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import sys
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from diffqc import tensor
+
+# lightweight stand-ins for the MRtrix commands used by diffQC, the tool is chosen by the
+# name the script is called with (see run_benchmarks.py, which links them into a bin folder);
+# they accept the command lines diffQC generates and write outputs of the same shape
+
+VERSION = '== %s 3.0-standin =='
+
+def parseArgs(argv, options):
+    # positional arguments and {option: [values]}, options maps names to their number of values
+    positional = []
+    values = {}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('-') and arg[1:] in options:
+            n = options[arg[1:]]
+            values[arg[1:]] = argv[i + 1:i + 1 + n]
+            i += 1 + n
+        else:
+            positional.append(arg)
+            i += 1
+    return (positional, values)
+
+def save(data, img, path):
+    nib.save(nib.Nifti1Image(np.asarray(data, dtype=np.float32), img.affine, img.header), path)
+
+def dwidenoise(argv):
+    (pos, opt) = parseArgs(argv, {'noise': 1, 'force': 0, 'nthreads': 1})
+    img = nib.load(pos[0])
+    data = np.asarray(np.asanyarray(img.dataobj), dtype=np.float32)
+    save(data, img, pos[1])
+    # noise level from the differences of consecutive volumes
+    noise = np.std(np.diff(data, axis=3), axis=3) / np.sqrt(2)
+    save(noise, img, opt['noise'][0])
+
+def dwi2tensor(argv):
+    (pos, opt) = parseArgs(argv, {'fslgrad': 2, 'predicted_signal': 1, 'force': 0, 'nthreads': 1})
+    img = nib.load(pos[0])
+    data = np.asanyarray(img.dataobj)
+    bvec = np.loadtxt(opt['fslgrad'][0])
+    bval = np.loadtxt(opt['fslgrad'][1])
+
+    mask = np.all(data > 0, axis=3)
+    fit = tensor.fitTensor(data, bval, tensor.gradientsToScanner(bvec, img.affine), mask)
+    save(fit['tensor'], img, pos[1])
+    if 'predicted_signal' in opt:
+        save(fit['predicted'], img, opt['predicted_signal'][0])
+
+def tensor2metric(argv):
+    (pos, opt) = parseArgs(argv, {'fa': 1, 'vector': 1, 'num': 1, 'force': 0, 'nthreads': 1})
+    img = nib.load(pos[0])
+    params = np.asarray(np.asanyarray(img.dataobj), dtype=np.float64)
+    fa, ev1 = tensor.tensorMetrics(params.reshape(-1, 6))
+    if 'fa' in opt:
+        save(fa.reshape(params.shape[:3]), img, opt['fa'][0])
+    if 'vector' in opt:
+        save(ev1.reshape(params.shape[:3] + (3,)), img, opt['vector'][0])
+
+def dwiextract(argv):
+    (pos, opt) = parseArgs(argv, {'shells': 1, 'fslgrad': 2, 'export_grad_fsl': 2, 'force': 0, 'nthreads': 1})
+    img = nib.load(pos[0])
+    bvec = np.loadtxt(opt['fslgrad'][0])
+    bval = np.loadtxt(opt['fslgrad'][1])
+
+    shells = np.array([float(b) for b in opt['shells'][0].split(',')])
+    nearest = np.argmin(np.abs(bval[:, np.newaxis] - shells[np.newaxis, :]), axis=1)
+    volumes = np.flatnonzero(np.abs(bval - shells[nearest]) <= np.maximum(0.15 * shells[nearest], 50))
+
+    save(np.asanyarray(img.dataobj)[..., volumes], img, pos[1])
+    np.savetxt(opt['export_grad_fsl'][0], bvec[:, volumes], fmt='%.6f')
+    np.savetxt(opt['export_grad_fsl'][1], bval[np.newaxis, volumes], fmt='%g')
+
+TOOLS = {'dwidenoise': dwidenoise, 'dwi2tensor': dwi2tensor, 'tensor2metric': tensor2metric,
+         'dwiextract': dwiextract}
+
+def main(argv):
+    tool = os.path.basename(argv[0])
+    if tool not in TOOLS:
+        print("unknown MRtrix stand-in: " + tool)
+        return 1
+    if '-version' in argv[1:]:
+        print(VERSION%tool)
+        return 0
+    TOOLS[tool](argv[1:])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+from diffqc import participant
+from diffqc import pipeline
+from diffqc import runner
+from diffqc import bidsindex
+
+# times every participant stage and the group step on a synthetic dataset with the MRtrix
+# stand-ins on PATH, and appends one JSON record per run to a history file
+STAGES = ('samplingScheme', 'getShells', 'denoise', 'brainMask', 'shellSpectra', 'dtiFit',
+          'faMap', 'mdsMap', 'tensorResiduals', 'anatOverlay')
+
+parser = argparse.ArgumentParser(description='diffQC benchmark on synthetic data')
+parser.add_argument('--subjects', type=int, default=2)
+parser.add_argument('--sessions', help='0 for no session level', type=int, default=0)
+parser.add_argument('--acqs', help='0 for no acq- entity', type=int, default=0)
+parser.add_argument('--matrix', type=int, nargs=3, default=[64, 64, 40])
+parser.add_argument('--shells', type=int, nargs='+', default=[1000, 2000])
+parser.add_argument('--dirs', help='directions per shell', type=int, default=30)
+parser.add_argument('--b0s', type=int, default=3)
+parser.add_argument('--tensor_backend', choices=['mrtrix', 'numpy'], default='mrtrix')
+parser.add_argument('--stage_threads', help='threads per acquisition, with more than 1 the stage '
+                    'numbers include the stages running next to them', type=int, default=1)
+parser.add_argument('--history', help='JSON lines file the results are appended to',
+                    default='benchmark_history.jsonl')
+parser.add_argument('--work_dir', help='Folder for dataset and outputs, a temporary one by default')
+parser.add_argument('--keep', help='Keep dataset and outputs', action='store_true')
+parser.add_argument('--threshold', help='change in %% vs. the last run from which wall time, peak memory '
+                    'and throughput of a stage are flagged as regression', type=float, default=10.0)
+
+# metrics compared to the last run: (name, column, sign of a regression)
+CHANGES = (('wall', 'wall_time', 1), ('peak', 'peak_mb', 1), ('throughput', 'throughput', -1))
+
+# timed calls that are running (nested or in parallel threads): [traced memory at the start, peak since];
+# tracemalloc runs for the whole benchmark and its peak is handed to all of them before it is reset
+_frames = []
+_framesLock = threading.Lock()
+
+def updatePeaks(reset=False):
+    peak = tracemalloc.get_traced_memory()[1]
+    for frame in _frames:
+        frame[1] = max(frame[1], peak)
+    # python < 3.9 can't reset the peak, it is then the peak since the start of the benchmark
+    if reset and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+def timed(name, func, stages):
+    # wall and cpu time, peak of the python/numpy allocations made within the call and the
+    # resources of the external commands it ran
+    def wrapper(*args, **kwargs):
+        nRecords = len(runner.records)
+        with _framesLock:
+            updatePeaks(reset=True)
+            current = tracemalloc.get_traced_memory()[0]
+            frame = [current, current]
+            _frames.append(frame)
+        wall = time.time()
+        cpu = time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage = stages.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                             'peak_mb': 0.0, 'tool_time': 0.0, 'tool_rss_mb': 0.0})
+            with _framesLock:
+                updatePeaks()
+                _frames[:] = [f for f in _frames if f is not frame]
+            records = runner.records[nRecords:]
+            stage['calls'] += 1
+            stage['wall_time'] += time.time() - wall
+            stage['cpu_time'] += time.process_time() - cpu + sum(r['cpu_time'] for r in records)
+            stage['peak_mb'] = max(stage['peak_mb'], (frame[1] - frame[0]) / 1024.0**2)
+            stage['tool_time'] += sum(r['wall_time'] for r in records)
+            stage['tool_rss_mb'] = max([stage['tool_rss_mb']] + [r['max_rss_mb'] for r in records])
+    return wrapper
+
+def standins(bin_dir):
+    # MRtrix stand-ins under the names of the real tools
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mrtrix_standins.py')
+    os.makedirs(bin_dir)
+    for tool in ('dwidenoise', 'dwi2tensor', 'tensor2metric', 'dwiextract'):
+        os.symlink(script, os.path.join(bin_dir, tool))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['PYTHONPATH'] = root + os.pathsep + os.environ.get('PYTHONPATH', '')
+
+def runGroup(bids_dir, output_dir):
+    start = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(root, 'run.py'), bids_dir, output_dir,
+                                'group', '--skip_bids_validator'], stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise Exception("group step failed")
+    return {'calls': 1, 'wall_time': time.time() - start, 'cpu_time': usage.ru_utime + usage.ru_stime,
+            'peak_mb': usage.ru_maxrss / 1024.0, 'tool_time': 0.0, 'tool_rss_mb': 0.0}
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', '-C', root, 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previousRun(history, config):
+    if not os.path.isfile(history):
+        return None
+    previous = None
+    with open(history) as fp:
+        for line in fp:
+            record = json.loads(line)
+            if record['config'] == config:
+                previous = record
+    return previous
+
+def changes(stage, previous, threshold):
+    # [(metric, change in %, regression)] vs. the same stage of the last run
+    result = []
+    for (metric, column, sign) in CHANGES:
+        if previous is None or previous.get(column, 0) <= 0:
+            continue
+        change = 100 * (stage[column] / previous[column] - 1)
+        result.append((metric, change, sign * change > threshold))
+    return result
+
+def printTable(record, previous, threshold=10.0):
+    # changes vs. the last run, regressions beyond threshold % are marked with !
+    print("%-16s %6s %10s %10s %10s %10s %12s   %s"%('stage', 'calls', 'wall [s]', 'cpu [s]', 'peak [MB]',
+                                                  'tools [MB]', 'Mvox*vol/s', 'vs. last'))
+    regressions = []
+    for name in STAGES + ('participant', 'group'):
+        if name not in record['stages']:
+            continue
+        stage = record['stages'][name]
+        last = previous['stages'].get(name) if previous is not None else None
+        stageChanges = changes(stage, last, threshold)
+        change = ' '.join('%s %+.0f%%%s'%(metric, c, '!' if bad else '') for (metric, c, bad) in stageChanges)
+        print("%-16s %6d %10.2f %10.2f %10.1f %10.1f %12.2f   %s"%(name, stage['calls'], stage['wall_time'],
+              stage['cpu_time'], stage['peak_mb'], stage['tool_rss_mb'], stage['throughput'], change))
+        regressions.extend('%s %s %+.0f%%'%(name, metric, change) for (metric, change, bad) in stageChanges if bad)
+    if regressions:
+        print("regressions vs. last run: " + ", ".join(regressions))
+    return regressions
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='diffqc_bench_')
+    bids_dir = os.path.join(work_dir, 'bids')
+    output_dir = os.path.join(work_dir, 'output')
+    standins(os.path.join(work_dir, 'bin'))
+
+    start = time.time()
+    files = synthetic.createDataset(bids_dir, args.subjects, args.sessions, args.acqs, args.matrix,
+                                    shells=args.shells, dirs=args.dirs, b0s=args.b0s)
+    generation = time.time() - start
+    voxelVolumes = len(files) * np.prod(args.matrix) * (len(args.shells) * args.dirs + args.b0s)
+
+    stages = {}
+    for name in STAGES:
+        setattr(participant, name, timed(name, getattr(participant, name), stages))
+    process = timed('participant', pipeline.processAcquisition, stages)
+
+    bids = bidsindex.load(bids_dir)
+    tracemalloc.start()
+    for job in pipeline.acquisitionJobs(bids, output_dir, bids.subjects(), tensor_backend=args.tensor_backend,
+                                        stage_threads=args.stage_threads):
+        process(job)
+    tracemalloc.stop()
+    stages['group'] = runGroup(bids_dir, output_dir)
+
+    for stage in stages.values():
+        stage['throughput'] = voxelVolumes / 1e6 / stage['wall_time'] if stage['wall_time'] > 0 else 0.0
+
+    config = {'subjects': args.subjects, 'sessions': args.sessions, 'acqs': args.acqs,
+              'matrix': args.matrix, 'shells': args.shells, 'dirs': args.dirs, 'b0s': args.b0s,
+              'tensor_backend': args.tensor_backend, 'stage_threads': args.stage_threads}
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': gitCommit(),
+              'host': socket.gethostname(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'config': config, 'acquisitions': len(files), 'generation_time': generation,
+              'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+              'stages': dict((name, stages[name]) for name in STAGES + ('participant', 'group') if name in stages)}
+
+    record['regressions'] = printTable(record, previousRun(args.history, config), args.threshold)
+    with open(args.history, 'a') as fp:
+        fp.write(json.dumps(record, sort_keys=True) + '\n')
+
+    if not args.keep and not args.work_dir:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,118 @@
+import os
+import json
+import numpy as np
+import nibabel as nib
+
+# synthetic BIDS datasets for benchmarking: an ellipsoid brain with a band of anisotropic
+# "white matter", DTI signal for a configurable acquisition scheme and Rician noise
+
+def sphereDirections(n, seed=0):
+    # quasi-uniform directions on the hemisphere (Fibonacci spiral), in random order
+    i = np.arange(n) + 0.5
+    z = 1 - i / n
+    phi = np.pi * (1 + 5**0.5) * i
+    r = np.sqrt(1 - z**2)
+    dirs = np.array([r * np.cos(phi), r * np.sin(phi), z])
+    return dirs[:, np.random.RandomState(seed).permutation(n)]
+
+def samplingScheme(shells=(1000, 2000), dirs=30, b0s=3):
+    # b=0 volumes spread over the acquisition, one set of directions per shell
+    bval = []
+    bvec = []
+    for i, b in enumerate(shells):
+        bval.extend([b] * dirs)
+        bvec.append(sphereDirections(dirs, seed=i))
+    bvec = np.concatenate(bvec, axis=1) if bvec else np.zeros((3, 0))
+    bval = np.array(bval, dtype=float)
+
+    b0Pos = np.linspace(0, len(bval), b0s, endpoint=False).astype(int) + np.arange(b0s)
+    for pos in b0Pos:
+        bval = np.insert(bval, pos, 0)
+        bvec = np.insert(bvec, pos, 0, axis=1)
+    return (bval, bvec)
+
+def phantom(matrix):
+    # S0, diffusion tensors (as 3x3 per voxel) and brain mask of the phantom
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in matrix], indexing='ij')
+    rr = grid[0]**2 / 0.8**2 + grid[1]**2 / 0.9**2 + grid[2]**2 / 0.85**2
+    brain = rr < 1
+
+    S0 = np.where(brain, 1000 - 300 * rr, 20)
+    D = np.zeros(tuple(matrix) + (3, 3))
+    md = np.where(brain, 0.8e-3, 3e-3)
+    for k in range(3):
+        D[..., k, k] = md
+
+    # band of fibres along x, curving with y
+    wm = np.logical_and(brain, np.abs(grid[2] - 0.3 * grid[1]**2) < 0.2)
+    angle = 0.8 * grid[1]
+    v = np.stack([np.cos(angle), np.sin(angle), np.zeros(angle.shape)], axis=-1)
+    l1, l2 = 1.7e-3, 0.3e-3
+    Dwm = l2 * np.eye(3) + (l1 - l2) * v[..., :, np.newaxis] * v[..., np.newaxis, :]
+    D[wm] = Dwm[wm]
+    return (S0, D, brain)
+
+def dwiSignal(matrix, bval, bvec, snr=30, seed=0):
+    S0, D, brain = phantom(matrix)
+    # signal decay per volume, bvecs are in voxel coordinates of the diagonal affine
+    q = np.einsum('iv,jv->vij', bvec, bvec)
+    adc = np.einsum('xyzij,vij->xyzv', D, q)
+    S = S0[..., np.newaxis] * np.exp(-bval * adc)
+
+    rng = np.random.RandomState(seed)
+    sigma = 1000.0 / snr
+    S = np.sqrt((S + sigma * rng.randn(*S.shape))**2 + (sigma * rng.randn(*S.shape))**2)
+    return S.astype(np.float32)
+
+def t1Image(matrix):
+    _, D, brain = phantom(matrix)
+    wm = D[..., 0, 0] != D[..., 1, 1]
+    t1 = np.where(brain, 600, 50) + 300 * wm
+    return t1.astype(np.float32)
+
+def entities(subject, session, acq):
+    name = 'sub-%s'%subject
+    if session is not None:
+        name += '_ses-%s'%session
+    if acq is not None:
+        name += '_acq-%s'%acq
+    return name
+
+def createDataset(bids_dir, subjects=2, sessions=0, acqs=0, matrix=(64, 64, 40), voxel=2.0,
+                  shells=(1000, 2000), dirs=30, b0s=3, snr=30, t1=True):
+    # sub-XX[/ses-Y]/dwi/sub-XX[_ses-Y][_acq-Z]_dwi.nii.gz with bval/bvec and an anatomical T1w
+    if not os.path.isdir(bids_dir):
+        os.makedirs(bids_dir)
+    with open(os.path.join(bids_dir, 'dataset_description.json'), 'w') as fp:
+        json.dump({'Name': 'diffQC synthetic benchmark', 'BIDSVersion': '1.1.1'}, fp)
+
+    bval, bvec = samplingScheme(shells, dirs, b0s)
+    affine = np.diag([voxel, voxel, voxel, 1.0])
+    affine[:3, 3] = -voxel * np.array(matrix) / 2
+    t1Matrix = tuple(2 * n for n in matrix)
+    t1Affine = np.diag([voxel / 2, voxel / 2, voxel / 2, 1.0])
+    t1Affine[:3, 3] = affine[:3, 3]
+
+    files = []
+    for s in range(subjects):
+        subject = '%02d'%(s + 1)
+        for session in ([None] if sessions < 1 else [str(i + 1) for i in range(sessions)]):
+            folder = os.path.join(bids_dir, 'sub-' + subject)
+            if session is not None:
+                folder = os.path.join(folder, 'ses-' + session)
+            for sub in ('dwi', 'anat'):
+                if not os.path.isdir(os.path.join(folder, sub)):
+                    os.makedirs(os.path.join(folder, sub))
+
+            for acq in ([None] if acqs < 1 else [str(i + 1) for i in range(acqs)]):
+                base = os.path.join(folder, 'dwi', entities(subject, session, acq) + '_dwi')
+                data = dwiSignal(matrix, bval, bvec, snr, seed=len(files))
+                nib.save(nib.Nifti1Image(data, affine), base + '.nii.gz')
+                np.savetxt(base + '.bval', bval[np.newaxis], fmt='%g')
+                np.savetxt(base + '.bvec', bvec, fmt='%.6f')
+                files.append(base + '.nii.gz')
+
+            if t1:
+                nib.save(nib.Nifti1Image(t1Image(t1Matrix), t1Affine),
+                         os.path.join(folder, 'anat', entities(subject, session, None) + '_T1w.nii.gz'))
+    return files
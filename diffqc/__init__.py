@@ -1 +1 @@
-__all__ = ["helper", "participant", "group"]
+__all__ = ["helper", "participant", "group", "pipeline", "scheduler", "cache", "tensor", "render", "artifacts", "runner", "statsindex", "spectral", "profiler", "bidsindex", "claims", "stagegraph"]
@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import hashlib
+import subprocess
+
+from diffqc import helper
+
+# persistent cache of external tool outputs, entries are keyed by the content of the input
+# files, the command line (with file names replaced) and the version of the tool
+_store = None
+_fileHashes = {}
+_toolVersions = {}
+
+class ArtifactCache(object):
+
+    def __init__(self, cache_dir, max_bytes=None, max_age=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def entryDir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, outputs):
+        entry = self.entryDir(key)
+        if not os.path.isdir(entry):
+            return False
+        for i, output in enumerate(outputs):
+            shutil.copyfile(os.path.join(entry, str(i)), output)
+        # last use for age based eviction
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, outputs):
+        entry = self.entryDir(key)
+        if os.path.isdir(entry):
+            return
+        # fill a private directory first, the rename makes the entry visible atomically
+        tmp = entry + '.tmp%d'%os.getpid()
+        os.makedirs(tmp)
+        for i, output in enumerate(outputs):
+            shutil.copyfile(output, os.path.join(tmp, str(i)))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored concurrently by another worker
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def entries(self):
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                if '.tmp' in key or not os.path.isdir(entry):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+        return sorted(entries)
+
+    def evict(self):
+        # drop entries not used within max_age seconds, then the least recently used ones until max_bytes is met
+        entries = self.entries()
+        now = time.time()
+        total = sum(e[1] for e in entries)
+        for (mtime, size, entry) in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            oversize = self.max_bytes is not None and total > self.max_bytes
+            if not expired and not oversize:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def configure(cache_dir, max_mb=None, max_age_days=None):
+    global _store
+    if not cache_dir:
+        _store = None
+        return None
+    max_bytes = None if max_mb is None else max_mb * 1024**2
+    max_age = None if max_age_days is None else max_age_days * 24 * 3600
+    _store = ArtifactCache(cache_dir, max_bytes, max_age)
+    return _store
+
+def fileHash(path):
+    st = os.stat(path)
+    stamp = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if stamp not in _fileHashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024**2), b''):
+                h.update(block)
+        _fileHashes[stamp] = h.hexdigest()
+    return _fileHashes[stamp]
+
+def toolVersion(tool):
+    if tool not in _toolVersions:
+        try:
+            out = subprocess.check_output([tool, '-version'], stderr=subprocess.STDOUT)
+            _toolVersions[tool] = str(out, 'utf-8').strip().split('\n')[0]
+        except (OSError, subprocess.CalledProcessError):
+            _toolVersions[tool] = 'unknown'
+    return _toolVersions[tool]
+
+def stageKey(cmd, inputs, outputs):
+    # file names don't matter, only the content of the inputs and the format of the outputs
+    names = [(path, '<out%d.%s>'%(i, os.path.basename(path).partition('.')[2])) for i, path in enumerate(outputs)]
+    names += [(path, '<in%d>'%i) for i, path in enumerate(inputs)]
+    for (path, name) in sorted(names, key=lambda n: -len(n[0])):
+        cmd = cmd.replace(path, name)
+    h = hashlib.sha256()
+    h.update(toolVersion(cmd.split()[0]).encode('utf-8'))
+    h.update(cmd.encode('utf-8'))
+    for path in inputs:
+        h.update(fileHash(path).encode('utf-8'))
+    return h.hexdigest()
+
+def run(cmd, inputs, outputs):
+    # helper.run with a lookup in the artifact cache (if configured)
+    if _store is None:
+        helper.run(cmd)
+        return
+    key = stageKey(cmd, inputs, outputs)
+    if _store.fetch(key, outputs):
+        return
+    helper.run(cmd)
+    _store.store(key, outputs)
@@ -0,0 +1,140 @@
+import os
+import json
+import socket
+import collections
+
+# index of the files of a BIDS dataset from a single scandir walk; the listing of every
+# directory is stored with its mtime, so a reused index only lists directories again
+# that changed since (files added, removed or renamed)
+DATATYPES = ('anat', 'dwi')
+
+def parseEntities(name):
+    # sub-01_ses-pre_acq-multi-band_dwi.nii.gz -> ({'sub': '01', 'ses': 'pre', 'acq': 'multi-band'}, 'dwi', '.nii.gz')
+    stem, dot, extension = name.partition('.')
+    parts = stem.split('_')
+    entities = collections.OrderedDict()
+    suffix = None
+    for part in parts:
+        key, dash, value = part.partition('-')
+        if dash:
+            entities[key] = value
+        else:
+            suffix = part
+    return (entities, suffix, dot + extension)
+
+def acquisitionName(path):
+    # name of a DWI acquisition with all its entities: sub-01_ses-pre_run-1_dwi.nii.gz -> sub-01_ses-pre_run-1
+    stem = os.path.basename(path).partition('.')[0]
+    return stem[:-len('_dwi')] if stem.endswith('_dwi') else stem
+
+class BidsIndex(object):
+
+    def __init__(self, bids_dir, index_file=None):
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.index_file = index_file
+        self.dirs = {}
+        if index_file and os.path.isfile(index_file):
+            with open(index_file) as fp:
+                stored = json.load(fp)
+            if stored.get('bids_dir') == self.bids_dir:
+                self.dirs = stored['dirs']
+        self.files = []
+        self.scan()
+
+    def listDir(self, rel):
+        # (subdirectories, {file: mtime}) of a directory, from the index if unchanged
+        path = os.path.join(self.bids_dir, rel)
+        mtime = os.stat(path).st_mtime
+        entry = self.dirs.get(rel)
+        if entry is None or entry['mtime'] != mtime:
+            subdirs = []
+            files = {}
+            for item in os.scandir(path):
+                if item.name.startswith('.'):
+                    continue
+                if item.is_dir():
+                    subdirs.append(item.name)
+                else:
+                    files[item.name] = item.stat().st_mtime
+            entry = {'mtime': mtime, 'subdirs': sorted(subdirs), 'files': files}
+            self.dirs[rel] = entry
+        return entry
+
+    def scan(self):
+        # subject folders, their session folders and the datatype folders below
+        seen = set()
+        files = []
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            entry = self.listDir(rel)
+            seen.add(rel)
+            level = os.path.split(rel)[-1]
+            for name in entry['subdirs']:
+                if rel == '':
+                    walk = name.startswith('sub-')
+                elif level.startswith('sub-'):
+                    walk = name.startswith('ses-') or name in DATATYPES
+                elif level.startswith('ses-'):
+                    walk = name in DATATYPES
+                else:
+                    walk = False
+                if walk:
+                    pending.append(os.path.join(rel, name))
+            if level not in DATATYPES:
+                continue
+            for name in sorted(entry['files']):
+                entities, suffix, extension = parseEntities(name)
+                if 'sub' not in entities:
+                    continue
+                f = {}
+                f['path'] = os.path.join(self.bids_dir, rel, name)
+                f['entities'] = entities
+                f['suffix'] = suffix
+                f['extension'] = extension
+                f['datatype'] = level
+                f['mtime'] = entry['files'][name]
+                files.append(f)
+
+        # forget directories that don't exist anymore
+        for rel in [r for r in self.dirs if r not in seen]:
+            del self.dirs[rel]
+        self.files = sorted(files, key=lambda f: f['path'])
+
+    def save(self):
+        if not self.index_file:
+            return
+        folder = os.path.dirname(self.index_file)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        # written to a private file first, concurrent runs (also on other hosts) may save the same index
+        tmp = self.index_file + '.tmp%s.%d'%(socket.gethostname(), os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump({'bids_dir': self.bids_dir, 'dirs': self.dirs}, fp)
+        os.rename(tmp, self.index_file)
+
+    def subjects(self):
+        return sorted(set(name[len('sub-'):] for name in self.dirs.get('', {'subdirs': []})['subdirs']
+                          if name.startswith('sub-')))
+
+    def query(self, subject=None, datatype=None, suffix=None, extensions=None, **entities):
+        # files matching all given criteria, entities e.g. ses='pre'
+        found = []
+        for f in self.files:
+            if subject is not None and f['entities']['sub'] != subject:
+                continue
+            if datatype is not None and f['datatype'] != datatype:
+                continue
+            if suffix is not None and f['suffix'] != suffix:
+                continue
+            if extensions is not None and f['extension'] not in extensions:
+                continue
+            if any(f['entities'].get(k) != v for k, v in entities.items()):
+                continue
+            found.append(f)
+        return found
+
+def load(bids_dir, index_file=None):
+    index = BidsIndex(bids_dir, index_file)
+    index.save()
+    return index
@@ -0,0 +1,102 @@
+import os
+import threading
+import collections
+import numpy as np
+import nibabel as nib
+
+class VolumeCache(object):
+    # decoded NIfTI arrays keyed by (path, mtime), least recently used are evicted first;
+    # arrays are converted to dtype (None keeps what nibabel returns); shared by the stage
+    # threads of an acquisition, files are loaded outside the lock
+
+    def __init__(self, max_bytes=4 * 1024**3, dtype=np.float32):
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._volumes = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, path):
+        path = os.path.realpath(path)
+        key = (path, os.stat(path).st_mtime_ns, str(self.dtype))
+
+        with self._lock:
+            if key in self._volumes:
+                self.hits += 1
+                self._volumes.move_to_end(key)
+                return self._volumes[key]
+            self.misses += 1
+
+        data = self.load(path)
+        # cached arrays are shared between stages, callers must copy before modifying
+        data.flags.writeable = False
+
+        with self._lock:
+            self.evict(path)
+            if self.size(data) <= self.max_bytes:
+                self._volumes[key] = data
+                self.nbytes += self.size(data)
+                self._shrink()
+        return data
+
+    def size(self, data):
+        # mapped files are paged in by the OS and don't count against max_bytes
+        return 0 if isinstance(data, np.memmap) else data.nbytes
+
+    def load(self, path):
+        img = nib.load(path)
+        if self.dtype is None:
+            return img.get_data()
+        if not hasattr(img.dataobj, 'get_unscaled'):
+            return np.asarray(img.get_data(), dtype=self.dtype)
+        unscaled = img.dataobj.get_unscaled()
+        slope = img.dataobj.slope
+        inter = img.dataobj.inter
+        scale = slope is not None and np.isfinite(slope) and slope != 1
+        offset = inter is not None and np.isfinite(inter) and inter != 0
+        if isinstance(unscaled, np.memmap) and unscaled.dtype == self.dtype and not scale and not offset:
+            # uncompressed files are mapped, only the parts that are accessed are read
+            return unscaled
+        # scaled integer data is converted once to dtype, not through float64
+        data = np.array(unscaled, dtype=self.dtype)
+        if scale:
+            data *= slope
+        if offset:
+            data += inter
+        return data
+
+    def evict(self, prefix):
+        # drop all entries of a file or directory, e.g. before it is deleted
+        prefix = os.path.realpath(prefix)
+        with self._lock:
+            for key in [k for k in self._volumes if k[0] == prefix or k[0].startswith(prefix + os.sep)]:
+                self.nbytes -= self.size(self._volumes.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._volumes.clear()
+            self.nbytes = 0
+
+    def setDtype(self, dtype):
+        self.dtype = dtype
+
+    def setMaxBytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        with self._lock:
+            self._shrink()
+
+    def _shrink(self):
+        while self.nbytes > self.max_bytes and self._volumes:
+            _, data = self._volumes.popitem(last=False)
+            self.nbytes -= self.size(data)
+
+    def report(self):
+        return "volume cache: %d hits, %d misses, %.1f MB in %d arrays"%(
+            self.hits, self.misses, self.nbytes / 1024.0**2, len(self._volumes))
+
+volumes = VolumeCache()
+
+def getData(path):
+    return volumes.get(path)
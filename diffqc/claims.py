@@ -0,0 +1,96 @@
+import os
+import time
+import errno
+import socket
+
+from diffqc import bidsindex
+
+# coordination of participant runs sharing one output_dir (e.g. array jobs on a cluster):
+# an acquisition is claimed by atomically creating its lock file in qc_locks, when it is
+# finished the lock is renamed to a done or failed marker, so every acquisition of the
+# queue is processed once; remove qc_locks (or single markers) to process them again
+LOCK_DIR = 'qc_locks'
+STATES = ('lock', 'done', 'failed')
+
+def parseShard(value):
+    # '2/8' -> (2, 8), shards are numbered from 0 like array task ids
+    index, _, count = value.partition('/')
+    index = int(index)
+    count = int(count)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("shard must be i/N with 0 <= i < N: " + value)
+    return (index, count)
+
+def shard(jobs, index, count):
+    # every count-th job, the job list is ordered the same way for every worker
+    return jobs[index::count]
+
+def lockName(job):
+    # the acquisition name of the DWI file (all entities, e.g. run-), which also names its folders
+    return bidsindex.acquisitionName(job['file'])
+
+def markerPath(job, state):
+    return os.path.join(job['output_dir'], LOCK_DIR, lockName(job) + '.' + state)
+
+def isStale(lock_file, timeout=None):
+    # lock of a worker that died: same host and the process is gone, or older than timeout hours
+    try:
+        with open(lock_file) as fp:
+            host, pid = fp.read().split()[:2]
+        age = time.time() - os.path.getmtime(lock_file)
+    except (IOError, OSError, ValueError):
+        # vanished or not written yet
+        return False
+    if timeout is not None and age > timeout * 3600:
+        return True
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+def claim(job, timeout=None):
+    # True if this process got the acquisition
+    lock_dir = os.path.join(job['output_dir'], LOCK_DIR)
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+    lock_file = markerPath(job, 'lock')
+    for attempt in range(2):
+        if any(os.path.exists(markerPath(job, state)) for state in STATES[1:]):
+            return False
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if attempt == 0 and isStale(lock_file, timeout):
+                print("removing stale lock " + lock_file)
+                try:
+                    os.remove(lock_file)
+                except OSError:
+                    pass
+                continue
+            return False
+        with os.fdopen(fd, 'w') as fp:
+            fp.write("%s %d %s\n"%(socket.gethostname(), os.getpid(), time.strftime('%Y-%m-%dT%H:%M:%S')))
+        # finished while the lock was created
+        if any(os.path.exists(markerPath(job, state)) for state in STATES[1:]):
+            os.remove(lock_file)
+            return False
+        return True
+    return False
+
+def release(job, failed=False):
+    marker = markerPath(job, 'failed' if failed else 'done')
+    try:
+        os.rename(markerPath(job, 'lock'), marker)
+    except OSError:
+        # the lock was taken for stale in the meantime
+        open(marker, 'w').close()
+
+def fail(job):
+    # an acquisition released as done failed afterwards (e.g. a figure rendered in the background)
+    try:
+        os.rename(markerPath(job, 'done'), markerPath(job, 'failed'))
+    except OSError:
+        open(markerPath(job, 'failed'), 'w').close()
@@ -1,8 +1,63 @@
-from glob import glob
 import os
+import multiprocessing
+
+def scanFigures(figFolder):
+    # single pass over qc_figures: figure file names per sub-* folder
+    figures = {}
+    if not os.path.isdir(figFolder):
+        return figures
+    for entry in os.scandir(figFolder):
+        if entry.is_dir() and entry.name.startswith('sub-'):
+            figures[entry.name] = sorted(f.name for f in os.scandir(entry.path) if f.name.endswith('.png'))
+    return figures
+
+def makeThumbnail(job):
+    (src, dst, scale) = job
+    # matplotlib only when there are thumbnails to render
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.image
+    matplotlib.image.thumbnail(src, dst, scale=scale)
+
+def createThumbnails(figFolder, thumbFolder, figures, n_procs=1, scale=0.15):
+    # downscaled copies of all figures, only missing or outdated thumbnails are rendered
+    jobs = []
+    for folder in figures:
+        if not os.path.isdir(os.path.join(thumbFolder, folder)):
+            os.makedirs(os.path.join(thumbFolder, folder))
+        for name in figures[folder]:
+            src = os.path.join(figFolder, folder, name)
+            dst = os.path.join(thumbFolder, folder, name)
+            if not os.path.isfile(dst) or os.path.getmtime(dst) < os.path.getmtime(src):
+                jobs.append((src, dst, scale))
+
+    if n_procs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=n_procs)
+        try:
+            pool.map(makeThumbnail, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            makeThumbnail(job)
+
+def pagePath(filePath, page):
+    # first page keeps the name of the report
+    if page == 0:
+        return filePath
+    return filePath[:-5] + "_%03d.html"%(page + 1)
 
 def createWebPage(wp):
-    with open(wp['filePath'], 'w') as fp:
+    folders = sorted(wp['subFolders'])
+    pageSize = wp.get('pageSize') or max(len(folders), 1)
+    nPages = max(1, (len(folders) + pageSize - 1) // pageSize)
+    for page in range(nPages):
+        writePage(wp, folders[page*pageSize:(page+1)*pageSize], page, nPages)
+
+def writePage(wp, subFolders, page, nPages):
+    outDir = os.path.dirname(wp['filePath'])
+    with open(pagePath(wp['filePath'], page), 'w') as fp:
         fp.write("<html>\n\t<body bgcolor=#FFF text=#000 style=\"font-family: Arial, Tahoma\">\n\n")
         fp.write("\t<script language=\"JavaScript\">\n\t\tfunction toggle(divClass) {\n\t\t\tclassDivs = document.getElementsByClassName(divClass);\n")
         fp.write("\t\t\tfor (var i=0; i<classDivs.length; i++) {\n\t\t\t\tdiv = classDivs[i];\n")
@@ -14,19 +69,29 @@ def createWebPage(wp):
         for item in wp['maxList']:
             fp.write("\t\t\t<input type=\"checkbox\" onclick=\"toggle('" + str(item) + "')\" checked>" + str(item).replace('_',' ') + "</input><br>\n")
         fp.write("\t\t</form>\n<p>\n\n")
+        if nPages > 1:
+            fp.write("\t\t<font size=2>page</font>\n")
+            for i in range(nPages):
+                if i == page:
+                    fp.write("\t\t<b>" + str(i + 1) + "</b>\n")
+                else:
+                    fp.write("\t\t<a href=\"" + os.path.basename(pagePath(wp['filePath'], i)) + "\">" + str(i + 1) + "</a>\n")
+            fp.write("\t\t<p>\n\n")
         fp.write("\t\t<div style=\"margin-left: 10px; float: right; padding: 3px; background-color: #CCC; border: 1px solid gray; border-radius: 7px;\" onclick=\"javascript: document.body.scrollTop = 0; document.documentElement.scrollTop = 0;\"><font size=2>scroll to top</font></div>\n")
         fp.write("\t</div>\n\n\t<div id=\"content\" style=\"margin-left: 280px; position: absolute; top: 10px; padding: 3px; border: 1px solid gray; border-radius: 7px; background-color: #FFF;\">\n")
 
 
         # loop over subjects
-        for subject_label in wp['subFolders']:
+        for folder in subFolders:
+            subject_label = folder[4:]
             fp.write("\t\t<table>\n")
             fp.write("\t\t\t<tr><td colspan=" + str(wp['maxImg']) + " bgcolor=#EEE><center><font size=3><b>sub-" + subject_label + "</b></font></center></td></tr>\n")
-            # loop over images
-            figures = glob(os.path.join(wp['figFolder'], "sub-%s"%subject_label,"*.png" ))
-            for image_file in sorted(figures):
-                # calcualte average mask size in voxels
-                fp.write("\t\t\t\t<td><div name=\"" + subject_label + "\" class=\"" + os.path.basename(image_file)[0:-4] + "\"><image src=\"" + image_file.replace(os.path.dirname(wp['filePath']) + os.sep, "") + "\" width=\"100%\"></div></td>\n")
+            fp.write("\t\t\t<tr>\n")
+            # loop over images, thumbnails are loaded lazily and link to the full figure
+            for name in wp['figures'].get(folder, []):
+                image_file = os.path.relpath(os.path.join(wp['figFolder'], folder, name), outDir)
+                thumb_file = os.path.relpath(os.path.join(wp['thumbFolder'], folder, name), outDir)
+                fp.write("\t\t\t\t<td><div name=\"" + subject_label + "\" class=\"" + name[0:-4] + "\"><a href=\"" + image_file + "\"><img src=\"" + thumb_file + "\" loading=\"lazy\" width=\"100%\"></a></div></td>\n")
             fp.write("\t\t\t</tr>")
             fp.write("\t\t</table>\n")
         fp.write("\t</div>\t</body>\n</html>")
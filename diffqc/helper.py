@@ -1,5 +1,4 @@
 import os.path
-import subprocess
 import numpy as np
 import nibabel as nib
 import matplotlib
@@ -7,23 +6,13 @@ matplotlib.use('Agg')
 import matplotlib.cm as cm
 import matplotlib.colors
 import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 from mpl_toolkits.axes_grid1 import ImageGrid
+from matplotlib.collections import LineCollection
+
+from diffqc import runner
 
 def run(command, env={}):
-    merged_env = os.environ
-    merged_env.update(env)
-    process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT, shell=True,
-                               env=merged_env)
-    while True:
-        line = process.stdout.readline()
-        line = str(line, 'utf-8')[:-1]
-        #print(line)
-        if line == '' and process.poll() != None:
-            break
-    if process.returncode != 0:
-        raise Exception("Non zero return code: %d"%process.returncode)
+    runner.run(command, env)
 
 def getImgThirds(img):
     indx = np.floor(np.linspace(img.shape[2]/3-1, img.shape[2]-img.shape[2]/3,3)).astype(int)
@@ -31,15 +20,101 @@ def getImgThirds(img):
     indz = np.floor(np.linspace(img.shape[0]/3-1, img.shape[0]-img.shape[0]/3,3)).astype(int)
     return [indx, indy, indz]
 
+def resamplePlanes(data, affine, shape, target_affine, ind):
+    # linear interpolation of data onto the planes ind (as given by getImgThirds) of the target grid
+    # only, zero outside of data; returns {(axis, index): plane}
+    from scipy import ndimage
+
+    M = np.linalg.inv(affine).dot(target_affine)
+    output = data.dtype if data.dtype.kind == 'f' else np.float64
+    planes = {}
+    for (axis, indices) in zip((2, 1, 0), ind):
+        inplane = [a for a in range(3) if a != axis]
+        grid = np.meshgrid(np.arange(shape[inplane[0]]), np.arange(shape[inplane[1]]), indexing='ij')
+        for i in indices:
+            coords = np.ones((4,) + grid[0].shape)
+            coords[inplane[0]] = grid[0]
+            coords[inplane[1]] = grid[1]
+            coords[axis] = i
+            voxels = np.tensordot(M[:3], coords, axes=1)
+            planes[(axis, i)] = ndimage.map_coordinates(data, voxels, output=output, order=1,
+                                                        mode='constant', cval=0)
+    return planes
 
 def normImg(img):
     return 255 * ((img - img.min()) / (img.max() - img.min()))
 
-def fourierSharpness(img):
-    f = np.fft.fftn(img, axes=(0, 1, 2))
-    shift = (np.array(f.shape)/2).astype(int)
-    AF = abs(np.roll(np.roll(np.roll(f, shift[0], axis=0), shift[1], axis=1), shift[2], axis=2))
-    return float(np.count_nonzero(AF > (np.max(AF)/1000))) / float(np.prod(img.shape))
+def clusterShells(bval):
+    # 1-D clustering of b-values: sorted values are split where neighbours differ by more than 15%,
+    # shells are the rounded cluster means in ascending order
+    bval = np.ravel(bval)
+    order = np.argsort(bval, kind='mergesort')
+    b = bval[order]
+    gaps = np.logical_not(np.isclose(b[1:], b[:-1], rtol=0.15))
+
+    shellind = np.empty(bval.size, dtype=int)
+    shellind[order] = np.concatenate(([0], np.cumsum(gaps)))
+
+    dirs_per_shell = np.bincount(shellind)
+    shells = np.round(np.bincount(shellind, weights=bval) / dirs_per_shell, decimals=-1)
+    shells[shells<50] = 0
+    return (shells, dirs_per_shell, shellind)
+
+def volumeView(data, volumes):
+    # ascending volume indices of a 4D image, a view if they are evenly spaced, a copy otherwise
+    volumes = np.asarray(volumes)
+    if volumes.size > 1 and np.all(np.diff(volumes) == volumes[1] - volumes[0]):
+        return data[:,:,:,volumes[0]:volumes[-1] + 1:volumes[1] - volumes[0]]
+    if volumes.size == 1:
+        return data[:,:,:,volumes[0]:volumes[0] + 1]
+    return data[:,:,:,volumes]
+
+def slabs(size, sliceBytes, max_memory=None):
+    # consecutive slices in slabs whose working arrays fit into max_memory MB, one slab without a limit
+    if max_memory is None:
+        step = size
+    else:
+        step = int(max(1, max_memory * 1024**2 // max(sliceBytes, 1)))
+    return [slice(i, min(i + step, size)) for i in range(0, size, step)]
+
+def fastMedian(data, dtype=np.float32):
+    # median along the last axis, by partitioning a copy in dtype instead of sorting
+    a = np.array(data, dtype=dtype)
+    k = a.shape[-1] // 2
+    if a.shape[-1] % 2:
+        a.partition(k, axis=-1)
+        return a[..., k]
+    a.partition([k - 1, k], axis=-1)
+    return (a[..., k - 1] + a[..., k]) / 2
+
+def sliceStats(data, axis=2, mask=None, positive=True):
+    # count, mean and variance of the valid voxels of every slice along axis for each volume of a 4D image,
+    # valid voxels are finite, inside the 3D mask and (if positive) larger than zero
+    axes = tuple(i for i in range(3) if i != axis)
+
+    valid = np.isfinite(data)
+    if positive:
+        with np.errstate(invalid='ignore'):
+            valid &= data > 0
+    if mask is not None:
+        valid &= np.expand_dims(mask.astype(bool), axis=3)
+
+    # values are kept in the precision of data (at least float), sums are accumulated in float64
+    x = np.where(valid, data, 0)
+    if x.dtype.kind != 'f':
+        x = x.astype(np.float64)
+    count = np.sum(valid, axis=axes)
+
+    mean = np.zeros(count.shape)
+    np.divide(np.sum(x, axis=axes, dtype=np.float64), count, out=mean, where=count>0)
+
+    # second pass on the centered values for a numerically stable variance
+    x -= np.expand_dims(np.expand_dims(mean, axis=axes[0]), axis=axes[1])
+    x *= valid
+    var = np.zeros(count.shape)
+    np.divide(np.sum(np.square(x, out=x), axis=axes, dtype=np.float64), count, out=var, where=count>0)
+
+    return (count, mean, var)
 
 def plotFig(img, title, voxSize):
 
@@ -111,7 +186,8 @@ def plotFig(img, title, voxSize):
     grid[1].set_title(title, fontsize=16)
 
 def plotTensor(img, ev1, title):
-    ev1[:,:,:,0] *= -1
+    # mirrored x component on a copy, the eigenvectors of the caller stay as they are
+    ev1 = ev1 * np.array([-1, 1, 1], dtype=ev1.dtype)
     ind = getImgThirds(img)
     fig = plt.figure(figsize=(20,20))
     grid = ImageGrid(fig,111,nrows_ncols=(3,3), axes_pad=0)
@@ -183,29 +259,28 @@ def plotTensor(img, ev1, title):
             limX = pltimg.shape[1]-1
             limY = pltimg.shape[0]-1
 
-            for x in range(0, pltimg.shape[1], res):
-                for y in range(0, pltimg.shape[0], res):
-                    if pltimg[y, x] > 0 :
-                        grad = vec[y-off2,x-off,:]
-                        col = abs(grad)/np.linalg.norm(grad)
-                        if i==0:
-                            # correct as is
-                            grad = grad
-                            col = col
-                        elif i==1:
-                            grad[1] = grad[1] * -1
-                            grad = grad[[0, 2, 1]]
-                        elif i==2:
-                            grad[0] = grad[0] * -1
-                            grad = grad[[1, 2, 0]]
-
-                        myX = [x - grad[0], x + grad[0]]
-                        myY = [y - grad[1], y + grad[1]]
-
-                        myX = np.clip(myX, 0, limX)
-                        myY = np.clip(myY, 0, limY)
-
-                        grid[cnt].plot(myX, myY, c=(col[0], col[1], col[2]), linewidth=1.5)
+            # all eigenvectors of a panel as one line collection, in the (x, y) order of the former per-voxel loop
+            x, y = np.nonzero(np.squeeze(pltimg, axis=2).T > 0)
+            keep = np.logical_and(x % res == 0, y % res == 0)
+            x = x[keep]
+            y = y[keep]
+
+            grad = vec[y-off2, x-off, :]
+            norm = np.linalg.norm(grad, axis=1)
+            col = np.zeros(grad.shape)
+            np.divide(np.abs(grad), norm[:, np.newaxis], out=col, where=norm[:, np.newaxis] > 0)
+            if i==1:
+                grad[:,1] = grad[:,1] * -1
+                grad = grad[:, [0, 2, 1]]
+            elif i==2:
+                grad[:,0] = grad[:,0] * -1
+                grad = grad[:, [1, 2, 0]]
+
+            myX = np.clip(np.stack((x - grad[:,0], x + grad[:,0]), axis=1), 0, limX)
+            myY = np.clip(np.stack((y - grad[:,1], y + grad[:,1]), axis=1), 0, limY)
+
+            segments = np.stack((myX, myY), axis=2)
+            grid[cnt].add_collection(LineCollection(segments, colors=col, linewidths=1.5))
 
             grid[cnt].axis('off')
             cnt = cnt + 1
@@ -238,6 +313,66 @@ def plotTensor(img, ev1, title):
 
 
 
+def plotSamplingScheme(bval, bvec, title):
+    qval = bval*bvec
+    iqval = -qval
+
+    # registers the 3d projection
+    from mpl_toolkits.mplot3d import Axes3D
+
+    fig = plt.figure(figsize=(10,10))
+
+    ax = fig.add_subplot(111, projection='3d')
+
+    norm = matplotlib.colors.Normalize(vmin=np.min(bval), vmax=np.max(bval), clip=True)
+    mapper = cm.ScalarMappable(norm=norm, cmap=cm.jet_r)
+    imapper = cm.ScalarMappable(norm=norm, cmap=cm.jet)
+
+    smp = ax.scatter(qval[0,:], qval[1,:], qval[2,:], c=mapper.to_rgba(bval), marker='o', s=70)
+    ismp = ax.scatter(iqval[0,:], iqval[1,:], iqval[2,:], c=imapper.to_rgba(bval), marker='^', s=70)
+
+    lim = np.ceil(np.max(np.abs(qval))/100)*100
+
+    ax.set_xlim3d(-lim, lim)
+    ax.set_ylim3d(-lim, lim)
+    ax.set_zlim3d(-lim, lim)
+
+    ax.set_aspect('equal', 'box')
+    ax.set_title(title)
+
+def plotSlices(slices, title):
+    # 3x3 grid of 2D slices
+    fig = plt.figure(figsize=(20,20))
+    grid = ImageGrid(fig,111,nrows_ncols=(3,3), axes_pad=0)
+
+    plt.subplots_adjust(wspace=0, hspace=0)
+    for cnt in range(len(slices)):
+        grid[cnt].imshow(slices[cnt], cm.gray, interpolation='none')
+        grid[cnt].axis('off')
+
+    grid[1].set_title(title, fontsize=16)
+
+def plotIntensityProfiles(profiles, shells, shellind):
+    # profiles: transversal, coronal and sagittal slice means, one column per volume
+    fig, ax = plt.subplots(nrows=shells.size, ncols=3, figsize=(15,3*shells.size), squeeze=False)
+    plt.subplots_adjust(wspace=0.1, hspace=0.1)
+
+    ax[0][0].set_title('transversal')
+    ax[0][1].set_title('coronal')
+    ax[0][2].set_title('sagittal')
+
+    for i in range(shells.size):
+        ax[i][0].set(ylabel = 'b = ' + str(int(shells[i])))
+
+    for i in range(shells.size):
+        for j in range(3):
+            ax[i][j].plot(profiles[j][:, shellind==i])
+
+    for i in range(ax.shape[0]):
+        for j in range(ax.shape[1]):
+            ax[i][j].axis('on')
+
+
 def fixImageHeader(img):
     # flip dimensions to clean up Header-Trafo
     dims = img.header.get_data_shape();
@@ -271,3 +406,21 @@ def fixImageHeader(img):
         M[:3,3] = -M[:3,:3].dot(orig[:3] - 1)
 
     return (M, perm, flip_sign)
+
+class Reorientation(object):
+    # canonical orientation of an image as defined by fixImageHeader: axes are permuted by perm and
+    # flipped where flip_sign < 0, apply and invert return strided views and never copy the data
+
+    def __init__(self, img):
+        (self.affine, self.perm, self.flip_sign) = fixImageHeader(img)
+        self._flip = tuple(slice(None, None, -1) if s < 0 else slice(None) for s in self.flip_sign)
+
+    def apply(self, data):
+        # image data (3D or 4D) as stored on disk -> canonical orientation
+        axes = list(self.perm) + list(range(3, data.ndim))
+        return np.transpose(data, axes)[self._flip]
+
+    def invert(self, data):
+        # canonical orientation -> image data as stored on disk
+        axes = list(np.argsort(self.perm)) + list(range(3, data.ndim))
+        return np.transpose(data[self._flip], axes)
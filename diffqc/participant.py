@@ -1,147 +1,155 @@
 import os
+import hashlib
+import threading
+import collections
 import nibabel as nib
 import numpy as np
 import pandas as pd
 
-import matplotlib
-import matplotlib.cm as cm
-import matplotlib.colors
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from mpl_toolkits.axes_grid1 import ImageGrid
-
-import sklearn.cluster
-from skimage import feature
-from statsmodels import robust
-
-from dipy.viz import regtools
-from dipy.align.imaffine import AffineMap
-from dipy.segment.mask import median_otsu
+# skimage and dipy are imported by the stages using them, on first use
 
 from diffqc import helper
-
+from diffqc import cache
+from diffqc import tensor
+from diffqc import render
+from diffqc import artifacts
+from diffqc import spectral
+from diffqc import profiler
+
+_shellCache = {}
+_t1Cache = collections.OrderedDict()
+_t1Lock = threading.Lock()
+
+def dataFile(dwi, tag, ext=None):
+    # intermediate image of the acquisition in data_dir, e.g. sub-01_denoised.nii
+    (base, _, fileExt) = os.path.split(dwi['file'])[-1].partition('_dwi.')
+    if ext is None:
+        ext = dwi.get('ext', '.' + fileExt)
+    return os.path.join(dwi['data_dir'], base + '_' + tag + ext)
+
+def dwiData(dwi):
+    # denoised data of the current shell, selected in memory by the multi-shell loop
+    if 'shellData' in dwi:
+        return dwi['shellData']
+    return cache.getData(dwi['denoised'])
+
+@profiler.profiled('stage')
 def samplingScheme(dwi):
     # img = nib.load(dwi['file'])
     bval = np.loadtxt(dwi['bval'])
     bvec = np.loadtxt(dwi['bvec'])
 
-    qval = bval*bvec
-    iqval = -qval
-
-    fig = plt.figure(figsize=(10,10))
-
-    ax = fig.add_subplot(111, projection='3d')
-
-    norm = matplotlib.colors.Normalize(vmin=np.min(bval), vmax=np.max(bval), clip=True)
-    mapper = cm.ScalarMappable(norm=norm, cmap=cm.jet_r)
-    imapper = cm.ScalarMappable(norm=norm, cmap=cm.jet)
-
-    smp = ax.scatter(qval[0,:], qval[1,:], qval[2,:], c=mapper.to_rgba(bval), marker='o', s=70)
-    ismp = ax.scatter(iqval[0,:], iqval[1,:], iqval[2,:], c=imapper.to_rgba(bval), marker='^', s=70)
-
-    lim = np.ceil(np.max(np.abs(qval))/100)*100
-
-    ax.set_xlim3d(-lim, lim)
-    ax.set_ylim3d(-lim, lim)
-    ax.set_zlim3d(-lim, lim)
-
-    ax.set_aspect('equal', 'box')
-    ax.set_title('acquisition scheme ' + dwi['subject_label'])
-
     plot_name = 'sampling_scheme.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
+    render.submit(helper.plotSamplingScheme, (bval, bvec, 'acquisition scheme ' + dwi['subject_label']),
+                  os.path.join(dwi['fig_dir'], plot_name))
 
+@profiler.profiled('stage')
 def getShells(dwi):
-    bval = np.loadtxt(dwi['bval'])
-    ub = np.unique(bval)
-    k = list(np.isclose(ub[1:],ub[:-1], rtol=0.15)).count(False) + 1
-    kmeans = sklearn.cluster.KMeans(n_clusters=k).fit(bval.reshape(-1,1))
-    shells = np.round(kmeans.cluster_centers_.ravel(), decimals=-1)
-    _, dirs_per_shell = np.unique(kmeans.labels_, return_counts=1)
-    sortind = np.argsort(shells)
-    shellind = np.argsort(sortind)
-    shells = shells[sortind]
-    dirs_per_shell = dirs_per_shell[sortind]
-    shellind = shellind[kmeans.labels_]
-    shells[shells<50] = 0
-    dwi['shells'] = shells
-    dwi['dirs_per_shell'] = dirs_per_shell
-    dwi['shellind'] = shellind
+    # shells only depend on the b-values, identical protocols are clustered once
+    with open(dwi['bval'], 'rb') as fp:
+        key = hashlib.sha1(fp.read()).hexdigest()
+    if key not in _shellCache:
+        bval = np.loadtxt(dwi['bval'])
+        _shellCache[key] = helper.clusterShells(bval)
+    (shells, dirs_per_shell, shellind) = _shellCache[key]
+    dwi['shells'] = shells.copy()
+    dwi['dirs_per_shell'] = dirs_per_shell.copy()
+    dwi['shellind'] = shellind.copy()
 
     print("shells: " + str(shells))
     print("# dirs: " + str(dirs_per_shell))
 
 
+@profiler.profiled('stage')
 def denoise(dwi):
-    dwi['denoised'] = os.path.join(dwi['data_dir'],
-                        os.path.split(dwi['file'])[-1].replace("_dwi.", "_denoised."))
-    dwi['noise'] = os.path.join(dwi['data_dir'],
-                        os.path.split(dwi['file'])[-1].replace("_dwi.", "_noise."))
+    dwi['denoised'] = dataFile(dwi, 'denoised')
+    dwi['noise'] = dataFile(dwi, 'noise')
     cmd = "dwidenoise %s %s -noise %s -force"%(dwi['file'],
                                                dwi['denoised'],
                                                dwi['noise'])
     # print(cmd)
-    helper.run(cmd)
+    artifacts.run(cmd, [dwi['file']], [dwi['denoised'], dwi['noise']])
 
-    noise = nib.load(dwi['noise'])
-    noiseMap = noise.get_data()
-    noiseMap = np.transpose(noiseMap, dwi['perm'])
+    noiseMap = np.array(dwi['reorient'].apply(cache.getData(dwi['noise'])))
     noiseMap[np.isnan(noiseMap)] = 0
 
-    if dwi['flip_sign'][0] < 0:
-        noiseMap = noiseMap[::-1,:,:]
-
-    if dwi['flip_sign'][1] < 0:
-        noiseMap = noiseMap[:,::-1,:]
-
-    if dwi['flip_sign'][2] < 0:
-        noiseMap = noiseMap[:,:,::-1]
-
-    helper.plotFig(noiseMap, 'Noise Map', dwi['voxSize'])
-
     plot_name = 'noise_map.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
-
+    render.submit(helper.plotFig, (noiseMap, 'Noise Map', dwi['voxSize']),
+                  os.path.join(dwi['fig_dir'], plot_name))
+
+def otsuMask(vol, factor=1):
+    # median_otsu mask, optionally estimated on a grid downsampled by factor (block means)
+    # with a correspondingly smaller median filter and upsampled again (nearest neighbour)
+    from dipy.segment.mask import median_otsu
+    if factor <= 1 or min(vol.shape) < 2 * factor:
+        _, mask = median_otsu(vol, 2, 1)
+        return mask
+
+    crop = [s // factor * factor for s in vol.shape]
+    small = np.reshape(vol[:crop[0], :crop[1], :crop[2]],
+                       (crop[0] // factor, factor, crop[1] // factor, factor, crop[2] // factor, factor))
+    small = np.mean(small, axis=(1, 3, 5))
+
+    _, mask = median_otsu(small, max(1, 2 // factor), 1)
+    for axis in range(3):
+        mask = np.repeat(mask, factor, axis=axis)
+    return np.pad(mask, [(0, s - c) for (s, c) in zip(vol.shape, crop)], 'edge')
+
+@profiler.profiled('stage')
 def brainMask(dwi):
-    img = nib.load(dwi['denoised'])
-    raw = img.get_data()
-
-    b0_raw = raw[:,:,:,dwi['shellind']==0]
-    if b0_raw.shape[3] > 0:
-        b0_raw = np.mean(b0_raw, axis=3)
-
-    raw = np.transpose(raw, np.hstack((dwi['perm'], 3)))
-    if dwi['flip_sign'][0] < 0:
-        raw = raw[::-1,:,:,:]
-
-    if dwi['flip_sign'][1] < 0:
-        raw = raw[:,::-1,:,:]
-
-    if dwi['flip_sign'][2] < 0:
-        raw = raw[:,:,::-1,:]
-
-
-    b0 = raw[:,:,:,dwi['shellind']==0]
-    mds = raw[:,:,:,dwi['shellind']!=0]
-    mds = np.median(mds, axis=3)
-
-    if b0.shape[3] > 0:
-        b0 = np.mean(b0, axis=3)
-
-    _, b0_mask = median_otsu(b0,2,1)
-    _, mds_mask = median_otsu(mds,2,1)
-
+    raw = cache.getData(dwi['denoised'])
+    b0_vols = dwi['shellind']==0
+    dw_vols = dwi['shellind']!=0
+
+    # mean b=0 and median diffusion weighted signal, computed in slabs of slices (on disk)
+    # so that only one slab of the selected volumes is copied at a time
+    if np.any(b0_vols):
+        b0_raw = np.zeros(raw.shape[:3], dtype=dwi['dtype'])
+    else:
+        b0_raw = raw[:,:,:,b0_vols]
+    mds = np.zeros(raw.shape[:3], dtype=dwi['dtype'])
+    # selected volumes and the median buffer per voxel and volume
+    sliceBytes = raw.shape[0] * raw.shape[1] * raw.shape[3] * (raw.itemsize + dwi['dtype'].itemsize)
+    for sl in helper.slabs(raw.shape[2], sliceBytes, dwi.get('max_memory')):
+        if np.any(b0_vols):
+            b0_raw[:,:,sl] = np.mean(raw[:,:,sl,b0_vols], axis=3, dtype=np.float64)
+        mds[:,:,sl] = helper.fastMedian(raw[:,:,sl,dw_vols], dwi['dtype'])
+
+    # reduce along the volumes first, then reorient the 3D maps
+    b0 = dwi['reorient'].apply(b0_raw)
+    mds = dwi['reorient'].apply(mds)
+
+    factor = dwi.get('mask_downsample', 1)
+    b0_mask = otsuMask(b0, factor)
+    mds_mask = otsuMask(mds, factor)
+
+    # the mask of the acquisition, used by all shells and the T1 overlay; also in the
+    # orientation on disk for the stages working on the data as stored
     dwi['b0'] = b0_raw
     dwi['mask'] = np.bitwise_or(b0_mask, mds_mask)
+    dwi['diskMask'] = dwi['reorient'].invert(dwi['mask'])
 
+    if dwi.get('keep_data'):
+        img = nib.load(dwi['denoised'])
+        mask_file = dataFile(dwi, 'brainmask')
+        nib.save(nib.Nifti1Image(dwi['diskMask'].astype(np.uint8), img.affine), mask_file)
+
+@profiler.profiled('stage')
 def dtiFit(dwi):
 
+    if dwi.get('tensor_backend') == 'numpy':
+        dtiFitNumpy(dwi)
+        return
+
     # DTI Fit to get residuals
     in_file = dwi['denoised']
-    dwi['tensor'] = dwi['denoised'].replace("_denoised", "_tensor")
-    dwi['dtiPredict'] = dwi['denoised'].replace("_denoised", "_dtFit")
+    if 'shellData' in dwi:
+        # dwi2tensor needs the selected volumes on disk, written uncompressed
+        img = nib.load(dwi['denoised'])
+        in_file = dataFile(dwi, 'shell', '.nii')
+        nib.save(nib.Nifti1Image(np.asarray(dwi['shellData']), img.affine, img.header), in_file)
+    dwi['tensor'] = dataFile(dwi, 'tensor')
+    dwi['dtiPredict'] = dataFile(dwi, 'dtFit')
 
     cmd = "dwi2tensor %s %s -fslgrad %s %s -predicted_signal %s -force"%(
                                                in_file,
@@ -151,226 +159,200 @@ def dtiFit(dwi):
                                                dwi['dtiPredict'])
 
     # print(cmd)
-    helper.run(cmd)
+    artifacts.run(cmd, [in_file, dwi['bvec'], dwi['bval']], [dwi['tensor'], dwi['dtiPredict']])
+    # the uncompressed selection is not kept in the output folder (with --keep_data), from a
+    # scratch directory intermediates are compressed when they are kept
+    if in_file != dwi['denoised'] and 'ext' not in dwi:
+        os.remove(in_file)
+
+def dtiFitNumpy(dwi):
+    # in-process DTI Fit inside the brain mask, results are kept in memory
+    bval = np.loadtxt(dwi['bval'])
+    bvec = np.loadtxt(dwi['bvec'])
+    img = nib.load(dwi['denoised'])
+    raw = dwiData(dwi)
 
-def faMap(dwi):
+    # brain mask back to the orientation of the data on disk
+    mask = dwi['diskMask']
+
+    g = tensor.gradientsToScanner(bvec, img.affine)
+    dwi['tensorFit'] = tensor.fitTensor(raw, bval, g, mask, dtype=dwi['dtype'])
+
+def faMapMrtrix(dwi):
 
-    fa_file = os.path.join(dwi['data_dir'],
-                os.path.split(dwi['file'])[-1].replace("_dwi.", "_fa" + "."))
-    ev1_file = os.path.join(dwi['data_dir'],
-                os.path.split(dwi['file'])[-1].replace("_dwi.", "_ev1" + "."))
+    fa_file = dataFile(dwi, 'fa')
+    ev1_file = dataFile(dwi, 'ev1')
     cmd = "tensor2metric %s -fa %s -vector %s -num 1 -force" % (
                                         dwi['tensor'],
                                         fa_file,
                                         ev1_file)
 
     # print(cmd)
-    helper.run(cmd)
+    artifacts.run(cmd, [dwi['tensor']], [fa_file, ev1_file])
 
     # get fa
-    fa = nib.load(fa_file)
-    faMap = fa.get_data()
-    faMap[np.isnan(faMap)] = 0
+    faMap = np.array(cache.getData(fa_file))
 
     # get primary eigenvector
-    ev = nib.load(ev1_file)
-    ev = ev.get_data()
-    ev[np.isnan(ev)] = 0
+    ev = np.array(cache.getData(ev1_file))
 
-    if dwi['flip_sign'][dwi['perm'][0]] < 0:
-        faMap = faMap[::-1,:,:]
-        ev = ev[::-1,:,:]
+    return (faMap, ev)
 
-    if dwi['flip_sign'][dwi['perm'][1]] < 0:
-        faMap = faMap[:,::-1,:]
-        ev = ev[:,::-1,:]
+@profiler.profiled('stage')
+def faMap(dwi):
 
-    if dwi['flip_sign'][dwi['perm'][2]] < 0:
-        faMap = faMap[:,:,::-1]
-        ev = ev[:,:,::-1]
+    if 'tensorFit' in dwi:
+        faMap = dwi['tensorFit']['fa']
+        ev = dwi['tensorFit']['ev1']
+    else:
+        (faMap, ev) = faMapMrtrix(dwi)
 
-    faMap = np.transpose(faMap, dwi['perm'])
-    faMap = faMap * dwi['mask']
+    faMap = faMap.astype(dwi['dtype'], copy=False)
+    ev = ev.astype(dwi['dtype'], copy=False)
+    faMap[np.isnan(faMap)] = 0
+    ev[np.isnan(ev)] = 0
 
-    helper.plotFig(faMap, 'fractional anisotropy', dwi['voxSize'])
+    faMap = dwi['reorient'].apply(faMap)
+    faMap = faMap * dwi['mask']
 
     plot_name = 'fractional_anisotropy' + '.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
+    render.submit(helper.plotFig, (faMap, 'fractional anisotropy', dwi['voxSize']),
+                  os.path.join(dwi['fig_dir'], plot_name))
 
-
-    ev = np.transpose(ev, np.hstack((dwi['perm'],3)))
-
-    helper.plotTensor(faMap, ev, 'tensor eigenvector')
+    ev = dwi['reorient'].apply(ev)
 
     plot_name = 'tensor_eigenvector' + '.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
-
-def mdsMap(dwi):
+    render.submit(helper.plotTensor, (faMap, ev, 'tensor eigenvector'),
+                  os.path.join(dwi['fig_dir'], plot_name))
 
-    img = nib.load(dwi['denoised'])
-    bval = np.loadtxt(dwi['bval'])
-
-    mdsMap = img.get_data()
-    mdsMap = np.mean(mdsMap[:,:,:,bval > 50], axis=3)
+def meanDiffusionSignal(dwi, data, volumes):
+    mdsMap = np.mean(data[:,:,:,volumes], axis=3, dtype=np.float64).astype(dwi['dtype'])
     mdsMap[np.isnan(mdsMap)] = 0
 
-    mdsMap = np.transpose(mdsMap, dwi['perm'])
+    mdsMap = dwi['reorient'].apply(mdsMap)
+    return mdsMap * dwi['mask']
 
-    if dwi['flip_sign'][0] < 0:
-        mdsMap = mdsMap[::-1,:,:]
+@profiler.profiled('stage')
+def shellSpectra(dwi, bShells):
+    # mean diffusion signal of every shell and its sharpness metrics from one batched transform,
+    # used by mdsMap in the multi-shell loop
+    raw = cache.getData(dwi['denoised'])
+    shellB = dwi['shells'][dwi['shellind']]
 
-    if dwi['flip_sign'][1] < 0:
-        mdsMap = mdsMap[:,::-1,:]
+    maps = [meanDiffusionSignal(dwi, raw, shellB == bShell) for bShell in bShells]
+    metrics = spectral.sharpnessMetrics(maps, dwi.get('nthreads') or -1)
 
-    if dwi['flip_sign'][2] < 0:
-        mdsMap = mdsMap[:,:,::-1]
+    dwi['shellMds'] = {}
+    for i, bShell in enumerate(bShells):
+        dwi['shellMds']["_b" + str(int(bShell))] = (maps[i], dict((k, float(v[i])) for k, v in metrics.items()))
 
-    mdsMap = mdsMap * dwi['mask']
+@profiler.profiled('stage')
+def mdsMap(dwi):
 
-    helper.plotFig(mdsMap, 'mean diffusion signal', dwi['voxSize'])
+    if dwi['shellStr'] in dwi.get('shellMds', {}):
+        (mdsMap, metrics) = dwi['shellMds'][dwi['shellStr']]
+    else:
+        bval = np.loadtxt(dwi['bval'])
+        mdsMap = meanDiffusionSignal(dwi, dwiData(dwi), bval > 50)
+        metrics = spectral.sharpnessMetrics(mdsMap, dwi.get('nthreads') or -1)
 
     plot_name = 'mean_diffusion_signal' + '.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
+    render.submit(helper.plotFig, (mdsMap, 'mean diffusion signal', dwi['voxSize']),
+                  os.path.join(dwi['fig_dir'], plot_name))
 
-    mdsSharpness = helper.fourierSharpness(mdsMap)
-
-    dwi['stats']['mds_sharpness'] = mdsSharpness
+    for name in spectral.METRICS:
+        dwi['stats']['mds_' + name] = metrics[name]
 
 
+@profiler.profiled('stage')
 def tensorResiduals(dwi):
     bval = np.loadtxt(dwi['bval'])
     bvec = np.loadtxt(dwi['bvec'])
-    img = nib.load(dwi['denoised'])
-    raw = img.get_data()
-    img_tensor = nib.load(dwi['dtiPredict'])
-    tensor_estimator = img_tensor.get_data()
-    raw[np.isnan(raw)] = 0
-    raw[np.isinf(raw)] = 0
-    tensor_estimator[np.isnan(tensor_estimator)] = 0
-    tensor_estimator[np.isinf(tensor_estimator)] = 0
-    res = np.sqrt((raw.astype(float) - tensor_estimator.astype(float))**2)
+    # all 4D data is used as views in the canonical orientation of brainMask
+    raw = dwi['reorient'].apply(dwiData(dwi))
+    if 'tensorFit' in dwi:
+        tensor_estimator = dwi['reorient'].apply(dwi['tensorFit']['predicted'])
+    else:
+        tensor_estimator = dwi['reorient'].apply(cache.getData(dwi['dtiPredict']))
 
     b0 = dwi['b0']
 
-    res[:,:,:,bval<=50] = 0
-    res[:,:,:,np.bitwise_and(bval>50, sum(bvec)==0)] = 0
-
     min_thresh = np.min(b0)
     max_thresh = np.max(b0)
     med_thresh = np.median(b0[b0>0])
 
     b0_mask = dwi['mask']
-
-    mask = np.repeat(np.expand_dims(np.invert(b0_mask), axis=3), raw.shape[3], axis=3)
-    res = np.transpose(res, np.hstack((dwi['perm'],3)))
-
-    res[np.isnan(res)] = 0
-    res[np.isinf(res)] = 0
-
-    res[res<min_thresh] = 0
-    res[res>max_thresh] = 0
-
-    res[mask]=0
-
-    res = np.transpose(res, np.hstack((np.argsort(dwi['perm']),3)))
-
-    if dwi['flip_sign'][0] < 0:
-        raw = raw[::-1,:,:,:]
-
-    if dwi['flip_sign'][1] < 0:
-        raw = raw[:,::-1,:,:]
-
-    if dwi['flip_sign'][2] < 0:
-        raw = raw[:,:,::-1,:]
+    noRes = np.bitwise_or(bval<=50, np.bitwise_and(bval>50, sum(bvec)==0))
+
+    # residuals and slice statistics of transversal slabs, all slices at once without a memory budget
+    sigStats = []
+    resStats = []
+    profiles = [np.zeros((raw.shape[2-j], raw.shape[3])) for j in range(3)]
+    # residuals and the temporaries of sliceStats per voxel and volume
+    sliceBytes = raw.shape[0] * raw.shape[1] * raw.shape[3] * 6 * dwi['dtype'].itemsize
+    for sl in helper.slabs(raw.shape[2], sliceBytes, dwi.get('max_memory')):
+        rawSlab = raw[:,:,sl]
+        maskSlab = b0_mask[:,:,sl]
+
+        res = np.subtract(rawSlab, tensor_estimator[:,:,sl], dtype=dwi['dtype'])
+        np.abs(res, out=res)
+
+        res[:,:,:,noRes] = 0
+        res[~np.isfinite(res)] = 0
+
+        res[res<min_thresh] = 0
+        res[res>max_thresh] = 0
+
+        # the 3D mask broadcasts over the volumes
+        res[~maskSlab] = 0
+
+        # slice statistics of signal and residuals inside the brain mask, transversal slices
+        sigStats.append(helper.sliceStats(rawSlab, mask=maskSlab))
+        resStats.append(helper.sliceStats(res, mask=maskSlab))
+        del res
+
+        # intensity sums per slice of every volume along the transversal, coronal and sagittal axis,
+        # non-finite voxels count as zero
+        finite = np.where(np.isfinite(rawSlab), rawSlab, 0)
+        profiles[0][sl] += np.sum(finite, axis=(0, 1), dtype=np.float64)
+        profiles[1] += np.sum(finite, axis=(0, 2), dtype=np.float64)
+        profiles[2] += np.sum(finite, axis=(1, 2), dtype=np.float64)
+        del finite
+
+    sigCount, sigMean, sigVar = [np.concatenate(s) for s in zip(*sigStats)]
+    resCount, resMean, resVar = [np.concatenate(s) for s in zip(*resStats)]
 
     # Plot tensor residuals
-    res = helper.normImg(res)
-
-    sl_res = np.sum(np.sum(res, axis=0), axis=0)
-    sl_res.shape
+    sl_res = resCount * resMean
 
     z, diff = np.unravel_index(np.argsort(sl_res, axis=None)[-9:],sl_res.shape)
 
-    fig = plt.figure(figsize=(20,20))
-    grid = ImageGrid(fig,111,nrows_ncols=(3,3), axes_pad=0)
-
-    plt.subplots_adjust(wspace=0, hspace=0)
-    cnt=0
-    for i in range(3):
-        for j in range(3):
-            pltimg = raw[:,::-1,z[cnt],diff[cnt]].T
-            grid[cnt].imshow(pltimg, cm.gray, interpolation='none')
-            grid[cnt].axis('off')
-            cnt = cnt + 1
-
-    shells = np.unique(dwi['shellind'])
-    grid[1].set_title('outlier slices according to tensor residuals', fontsize=16)
+    slices = []
+    for cnt in range(z.size):
+        pltimg = np.array(raw[:,::-1,z[cnt],diff[cnt]].T, dtype=dwi['dtype'])
+        pltimg[~np.isfinite(pltimg)] = 0
+        slices.append(pltimg)
 
     plot_name = 'tensor_residuals' + '.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
+    render.submit(helper.plotSlices, (slices, 'outlier slices according to tensor residuals'),
+                  os.path.join(dwi['fig_dir'], plot_name))
 
     # Plot Intensity Values per shell
-    raw = np.transpose(raw, np.hstack((np.argsort(dwi['perm']),3)))
-
-    fig, ax = plt.subplots(nrows=shells.size, ncols=3, figsize=(15,3*shells.size))
-    plt.subplots_adjust(wspace=0.1, hspace=0.1)
-
-    ax[0][0].set_title('transversal')
-    ax[0][1].set_title('coronal')
-    ax[0][2].set_title('sagittal')
-
-    for i in range(dwi['shells'].size):
-        ax[i][0].set(ylabel = 'b = ' + str(int(dwi['shells'][i])))
-
-    for i in range(bval.shape[0]):
-        ax[dwi['shellind'][i]][0].plot(np.mean(np.mean(raw[:,:,:,i],axis=0),axis=0))
-        ax[dwi['shellind'][i]][1].plot(np.mean(np.mean(raw[:,:,:,i],axis=2),axis=0))
-        ax[dwi['shellind'][i]][2].plot(np.mean(np.mean(raw[:,:,:,i],axis=1),axis=1))
-
-    for i in range(ax.shape[0]):
-        for j in range(ax.shape[1]):
-            ax[i][j].axis('on')
+    # mean intensity per slice of every volume along the transversal, coronal and sagittal axis
+    for j in range(3):
+        profiles[j] /= np.prod(raw.shape[:3]) / raw.shape[2-j]
 
     plot_name = 'intensity_values' + '.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
+    render.submit(helper.plotIntensityProfiles, (profiles, dwi['shells'], dwi['shellind']),
+                  os.path.join(dwi['fig_dir'], plot_name))
 
     # calculate Slicewise Signal Intenstiy Outlier according to Sairanen et al. 2018
 
     tl = 3.5
     tu = 10
 
-    raw = np.transpose(raw, np.hstack((dwi['perm'],3)))
-    sigMap = raw[:,:,:,bval > 50]
-    resMap = res[:,:,:,bval > 50]
-
-    b0_mask = np.transpose(b0_mask, dwi['perm'])
-    mask = np.repeat(np.expand_dims(np.invert(b0_mask), axis=3), sigMap.shape[3], axis=3)
-
-    sigMap[mask] = 0
-    sigMap[np.isnan(sigMap)] = 0
-    sigMap[np.isinf(sigMap)] = 0
-    resMap[mask] = 0
-    resMap[np.isnan(resMap)] = 0
-    resMap[np.isinf(resMap)] = 0
-
-    varSig = np.zeros(sigMap.shape[2:])
-    varRes = np.zeros(resMap.shape[2:])
-
-    for j in range(sigMap.shape[2]):
-        for i in range(sigMap.shape[3]):
-            slSig = np.ravel(sigMap[:,:,j,i])
-            slReg = np.ravel(resMap[:,:,j,i])
-            if slSig[slSig>0].size:
-                varSig[j,i] = np.var(slSig[slSig>0])
-                # varSig[j,i] = np.mean(slSig[slSig>0])
-            if slReg[slReg>0].size:
-                varRes[j,i] = np.var(slReg[slReg>0])
-                # varRes[j,i] = np.mean(slReg[slReg>0])
+    varSig = sigVar[:, bval > 50]
+    varRes = resVar[:, bval > 50]
 
     # print(varSig)
     # print(varRes)
@@ -418,71 +400,75 @@ def tensorResiduals(dwi):
     dwi['stats']['signal_outlier'] = np.mean(np.ravel(sigOutlier))
     dwi['stats']['residual_outlier'] = np.mean(np.ravel(resOutlier))
 
+def normalizedT1(t1_file, keep=2):
+    # reoriented T1 scaled to [0,255] as uint8 (as written to the overlay), kept for the following
+    # acquisitions of the same subject/session
+    st = os.stat(t1_file)
+    key = (os.path.realpath(t1_file), st.st_mtime_ns)
+    with _t1Lock:
+        if key in _t1Cache:
+            _t1Cache.move_to_end(key)
+            return _t1Cache[key]
+
+    imgT1 = nib.load(t1_file)
+    reorientT1 = helper.Reorientation(imgT1)
+    t1 = helper.normImg(reorientT1.apply(cache.getData(t1_file))).astype(np.uint8)
+    t1.flags.writeable = False
+    cache.volumes.evict(t1_file)
+    entry = (t1, reorientT1.affine, imgT1.header['pixdim'][1:4])
+    # overlays of several T1s may run in parallel threads
+    with _t1Lock:
+        _t1Cache[key] = entry
+        while len(_t1Cache) > keep:
+            _t1Cache.popitem(last=False)
+    return entry
+
+@profiler.profiled('stage')
 def anatOverlay(dwi,t1):
+    from skimage import feature
+
     if t1['file'].split("acq-")[-1] != t1['file']:
         t1_acq = '_acq-' + t1['file'].split("acq-")[-1].split("_")[0]
     else:
         t1_acq = ''
 
-    imgT1 = nib.load(t1['file'])
     img = nib.load(dwi['denoised'])
 
     b0_affine = img.affine
     b0 = dwi['b0']
 
-    b0_mask = dwi['mask']
+    # b0 is kept in the orientation on disk, as is diskMask
+    b0_mask = dwi['diskMask']
 
     b0 = b0 * b0_mask
-    t1 = imgT1.get_data()
-    t1_affine = imgT1.affine
-
-    (t1_affine, perm, flip_sign) = helper.fixImageHeader(imgT1)
-
-    t1 = np.transpose(t1, perm)
 
-    if flip_sign[0] < 0:
-        t1 = t1[::-1,:,:]
-
-    if flip_sign[1] < 0:
-        t1 = t1[:,::-1,:]
-
-    if flip_sign[2] < 0:
-        t1 = t1[:,:,::-1]
-
-    affine_map = AffineMap(np.eye(4),
-                           t1.shape, t1_affine,
-                           b0.shape, b0_affine)
-
-    resampled = affine_map.transform(np.array(b0))
-
-    # Normalize the input images to [0,255]
-    t1 = helper.normImg(t1)
-    b0 = helper.normImg(resampled)
-
-    overlay = np.zeros(shape=(t1.shape) + (3,), dtype=np.uint8)
-    b0_canny = np.zeros(shape=(t1.shape), dtype=np.bool)
+    (t1, t1_affine, voxSize) = normalizedT1(t1['file'])
 
+    # only the planes shown in the figure are resampled into the T1 grid and edge detected; the
+    # b0 is normalized to [0,255] by the range of the whole volume, which the linear interpolation
+    # keeps (0 outside of the b0)
     ind = helper.getImgThirds(t1)
+    planes = helper.resamplePlanes(b0, b0_affine, t1.shape, t1_affine, ind)
+    low = min(b0.min(), 0)
+    high = b0.max()
 
-    for i in ind[0]:
-        b0_canny[:,:,i] = feature.canny(b0[:,:,i], sigma=1.5)
-
-    for i in ind[1]:
-        b0_canny[:,i,:] = feature.canny(np.squeeze(b0[:,i,:]), sigma=1.5)
+    overlay = np.zeros(shape=(t1.shape) + (3,), dtype=np.uint8)
+    b0_canny = np.zeros(shape=(t1.shape), dtype=bool)
 
-    for i in ind[2]:
-        #b0_canny[i-1,:,:] = feature.canny(np.squeeze(b0[i-1,:,:]), sigma=1.5)
-        b0_canny[i,:,:] = feature.canny(np.squeeze(b0[i,:,:]), sigma=1.5)
-        #b0_canny[i+1,:,:] = feature.canny(np.squeeze(b0[i+1,:,:]), sigma=1.5)
+    for ((axis, i), plane) in planes.items():
+        edges = feature.canny(255 * (plane - low) / (high - low), sigma=1.5)
+        if axis == 2:
+            b0_canny[:,:,i] = edges
+        elif axis == 1:
+            b0_canny[:,i,:] = edges
+        else:
+            b0_canny[i,:,:] = edges
 
     overlay[..., 0] = t1
     overlay[..., 1] = t1
     overlay[..., 2] = t1
     overlay[..., 0] = b0_canny*255
 
-    voxSize = imgT1.header['pixdim'][1:4]
-
-    helper.plotFig(overlay, 'alignment DWI -> T1', voxSize) #[perm])
     plot_name = 't1' + t1_acq + '_overlay.png'
-    plt.savefig(os.path.join(dwi['fig_dir'], plot_name), bbox_inches='tight')
-    plt.close()
+    render.submit(helper.plotFig, (overlay, 'alignment DWI -> T1', voxSize), #[perm])
+                  os.path.join(dwi['fig_dir'], plot_name))
@@ -0,0 +1,336 @@
+import os
+import gzip
+import shutil
+import collections
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+from diffqc import helper
+from diffqc import participant
+from diffqc import cache
+from diffqc import artifacts
+from diffqc import runner
+from diffqc import statsindex
+from diffqc import bidsindex
+from diffqc import profiler
+from diffqc import stagegraph
+from diffqc import spectral
+
+NIFTI = ('.nii', '.nii.gz')
+# stats columns in this order whichever stage finishes first, other columns follow as they are added
+STATS_COLUMNS = (('subject_label', 'voxel_size') + tuple('mds_' + name for name in spectral.METRICS) +
+                 ('signal_outlier', 'residual_outlier'))
+
+def acquisitionJobs(bids, output_dir, subjects_to_analyze, keep_data=False, cache_mem=4096,
+                    tensor_backend='mrtrix', artifact_cache=None, nthreads=None, max_memory=None,
+                    profile=False, mask_downsample=1, dtype='float32',
+                    work_dir=None, claim=False, claim_timeout=None, stage_threads=1):
+    # one job per DWI-File, jobs only hold plain values so they can be sent to workers
+    jobs = []
+    for subject_label in subjects_to_analyze:
+        for dwi_file in bids.query(subject_label, datatype='dwi', suffix='dwi', extensions=NIFTI):
+            # T1s of the same session, all T1s of the subject for DWIs without session
+            entities = {}
+            if 'ses' in dwi_file['entities']:
+                entities['ses'] = dwi_file['entities']['ses']
+            t1_files = bids.query(subject_label, datatype='anat', suffix='T1w', extensions=NIFTI, **entities)
+
+            job = {}
+            job['subject_label'] = subject_label
+            job['file'] = dwi_file['path']
+            job['entities'] = dict(dwi_file['entities'])
+            job['t1_files'] = [t1['path'] for t1 in t1_files]
+            job['bids_dir'] = bids.bids_dir
+            job['output_dir'] = output_dir
+            job['keep_data'] = keep_data
+            job['cache_mem'] = cache_mem
+            job['tensor_backend'] = tensor_backend
+            job['artifact_cache'] = artifact_cache
+            job['nthreads'] = nthreads
+            job['max_memory'] = max_memory
+            job['profile'] = profile
+            job['mask_downsample'] = mask_downsample
+            job['dtype'] = dtype
+            job['work_dir'] = work_dir
+            job['claim'] = claim
+            job['claim_timeout'] = claim_timeout
+            job['stage_threads'] = stage_threads
+            jobs.append(job)
+    return jobs
+
+def acquisitionName(job):
+    # name of the folders of an acquisition, from all entities of the DWI file (e.g. run-) so
+    # that acquisitions of the same session never share a folder
+    return bidsindex.acquisitionName(job['file'])
+
+def isAcquisitionFolder(job, folder):
+    # the folder of the acquisition or of one of its shells
+    name = acquisitionName(job)
+    return folder == name or (folder.startswith(name + '_b') and folder[len(name) + 2:].isdigit())
+
+def writeStats(stats, stats_dir, output_dir):
+    columns = [c for c in STATS_COLUMNS if c in stats] + [c for c in stats if c not in STATS_COLUMNS]
+    df = pd.DataFrame(stats, columns=columns)
+    stats_file = os.path.join(stats_dir, "stats.tsv")
+    df.to_csv(stats_file, sep="\t", index=False)
+    statsindex.record(output_dir, stats_file)
+
+def cleanupData(data_dir, keep_dir=None):
+    # remove the intermediates of data_dir; to keep them, files in a scratch directory are
+    # moved to keep_dir (images compressed on the way), data in keep_dir itself stays
+    cache.volumes.evict(data_dir)
+    if keep_dir == data_dir:
+        return
+    if keep_dir is not None:
+        if not os.path.isdir(keep_dir):
+            os.makedirs(keep_dir)
+        for name in os.listdir(data_dir):
+            path = os.path.join(data_dir, name)
+            if name.endswith('.nii'):
+                with open(path, 'rb') as src, gzip.open(os.path.join(keep_dir, name + '.gz'), 'wb', 1) as dst:
+                    shutil.copyfileobj(src, dst, 1024**2)
+            elif os.path.isfile(path):
+                shutil.copyfile(path, os.path.join(keep_dir, name))
+    shutil.rmtree(data_dir)
+
+def removeAcquisitionData(job):
+    # intermediates left behind by an acquisition (e.g. when it failed), its shell folders
+    # included; folders are found by the acquisition name that also names the lock file of
+    # the acquisition, folders of other acquisitions in the same qc_data are not touched
+    roots = []
+    if job['work_dir']:
+        roots.append(job['work_dir'])
+    if not job['keep_data']:
+        roots.append(job['output_dir'])
+    for root in roots:
+        qc_data = os.path.join(root, 'qc_data')
+        if not os.path.isdir(qc_data):
+            continue
+        for folder in os.listdir(qc_data):
+            if isAcquisitionFolder(job, folder):
+                cache.volumes.evict(os.path.join(qc_data, folder))
+                shutil.rmtree(os.path.join(qc_data, folder), ignore_errors=True)
+        # the last worker removes the shared folder
+        try:
+            os.rmdir(qc_data)
+        except OSError:
+            pass
+
+def fitStages(dwi, shellStr, data, mask, tensor_backend):
+    # tensor fit, FA, mean diffusion signal and residuals of a shell (or of all data); data and
+    # mask are the resources the stages read beyond those of the shell itself
+    fitInputs = data + (('diskMask',) if tensor_backend == 'numpy' and mask else ())
+    return [stagegraph.node('dtiFit' + shellStr, participant.dtiFit, (dwi,), fitInputs, ('tensor' + shellStr,)),
+            stagegraph.node('faMap' + shellStr, participant.faMap, (dwi,),
+                            ('tensor' + shellStr,) + mask, ('fa' + shellStr,)),
+            stagegraph.node('mdsMap' + shellStr, participant.mdsMap, (dwi,), data + mask, ('mds' + shellStr,)),
+            stagegraph.node('tensorResiduals' + shellStr, participant.tensorResiduals, (dwi,),
+                            ('tensor' + shellStr,) + mask, ('residuals' + shellStr,))]
+
+def shellAcquisition(dwi, shell, bShell, fullBval, fullBvec):
+    # one shell and the b=0 volumes as an acquisition of its own: results of the full
+    # acquisition (mask, b0, spectra) are shared, folders and stats are separate
+    shell.update(dwi)
+    shell['shellStr'] = "_b" + str(int(bShell))
+
+    shell['data_dir'] = dwi['data_dir'] + shell['shellStr']
+    shell['fig_dir'] = dwi['fig_dir'] + shell['shellStr']
+    shell['stats_dir'] = dwi['stats_dir'] + shell['shellStr']
+
+    shell['stats'] = collections.OrderedDict(dwi['stats'])
+    shell['stats']['subject_label'] = dwi['subject_label'] + shell['shellStr']
+
+    # create output folder
+    if not os.path.isdir(shell['data_dir']):
+        os.makedirs(shell['data_dir'])
+    if not os.path.isdir(shell['fig_dir']):
+        os.makedirs(shell['fig_dir'])
+    if not os.path.isdir(shell['stats_dir']):
+        os.makedirs(shell['stats_dir'])
+
+    # b=0 and this shell are selected from the denoised data in memory, only the
+    # gradient subsets are written (getShells and dwi2tensor read them from disk)
+    volumes = np.flatnonzero(np.logical_or(dwi['shells'][dwi['shellind']] == 0,
+                                           dwi['shells'][dwi['shellind']] == bShell))
+    shell['shellData'] = helper.volumeView(cache.getData(dwi['denoised']), volumes)
+
+    shell['bval'] = os.path.join(shell['data_dir'],
+                    os.path.split(shell['file'])[-1].replace("_dwi.", "_shell.").split('.')[0] + '.bval')
+    shell['bvec'] = shell['bval'].replace('.bval', '.bvec')
+    np.savetxt(shell['bval'], fullBval[np.newaxis, volumes], fmt='%g')
+    np.savetxt(shell['bvec'], fullBvec[:, volumes], fmt='%.6f')
+
+def finishShell(shell, output_dir, keep_dir):
+    writeStats(shell['stats'], shell['stats_dir'], output_dir)
+    cleanupData(shell['data_dir'], keep_dir)
+    # the shell dict lives until the acquisition is done (its stats are merged at the end),
+    # its 4D data and fit are released as soon as the shell is finished
+    shell.pop('shellData', None)
+    shell.pop('tensorFit', None)
+
+def processAcquisition(job):
+    subject_label = job['subject_label']
+    dwi_file = job['file']
+
+    print("processing sub-" + subject_label + ": " + os.path.basename(dwi_file) + "\n")
+
+    cache.volumes.setMaxBytes(job['cache_mem'] * 1024**2)
+    cache.volumes.setDtype(np.dtype(job['dtype']))
+    artifacts.configure(job['artifact_cache'])
+
+    # create subj dir in qc_data & qc_figures folders, intermediates go to the scratch
+    # directory if given; folders are named after subject, session and acquisition
+    data_root = job['work_dir'] or job['output_dir']
+    name = acquisitionName(job)
+    subject_dir = os.path.join(data_root, 'qc_data', name)
+    fig_dir = os.path.join(job['output_dir'], 'qc_figures', name)
+    stats_dir = os.path.join(job['output_dir'], 'qc_stats', name)
+
+    # kept intermediates end up in the output folder
+    keep_dir = None
+    if job['keep_data']:
+        keep_dir = os.path.join(job['output_dir'], 'qc_data', os.path.basename(subject_dir))
+
+    # create output folder
+    if not os.path.isdir(subject_dir):
+        os.makedirs(subject_dir)
+    if not os.path.isdir(fig_dir):
+        os.makedirs(fig_dir)
+    if not os.path.isdir(stats_dir):
+        os.makedirs(stats_dir)
+
+    # log of all external commands of this acquisition
+    runner.reset()
+    runner.configure(job['nthreads'], os.path.join(stats_dir, 'commands.log'))
+    profiler.configure(job['profile'], job['stage_threads'] > 1)
+    profiler.reset()
+
+    # add acquisition directory
+    dwi = {}
+    dwi['subject_label'] = subject_label
+    dwi['fig_dir'] = fig_dir
+    dwi['data_dir'] = subject_dir
+    dwi['stats_dir'] = stats_dir
+    dwi['file'] = dwi_file
+    dwi['tensor_backend'] = job['tensor_backend']
+    dwi['max_memory'] = job['max_memory']
+    dwi['nthreads'] = job['nthreads']
+    dwi['keep_data'] = job['keep_data']
+    dwi['mask_downsample'] = job['mask_downsample']
+    dwi['dtype'] = np.dtype(job['dtype'])
+    # intermediates in the scratch directory are uncompressed and memory-mapped when read
+    if job['work_dir']:
+        dwi['ext'] = '.nii'
+    dwi['bval'] = dwi['file'].replace("_dwi.nii.gz", "_dwi.bval")
+    dwi['bval'] = dwi['bval'].replace("_dwi.nii", "_dwi.bval")
+    dwi['bvec'] = dwi['file'].replace("_dwi.nii.gz", "_dwi.bvec")
+    dwi['bvec'] = dwi['bvec'].replace("_dwi.nii", "_dwi.bvec")
+
+    # Get Header and flip_sign
+    img = nib.load(dwi['file'])
+
+    reorient = helper.Reorientation(img)
+
+    voxSize = img.header['pixdim'][1:4]
+
+    dwi['reorient'] = reorient
+    dwi['M'] = reorient.affine
+    dwi['perm'] = reorient.perm
+    dwi['flip_sign'] = reorient.flip_sign
+    dwi['voxSize'] = voxSize[reorient.perm]
+    stats = collections.OrderedDict()
+    stats['subject_label'] = subject_label
+    stats['voxel_size'] = [np.round(voxSize, decimals=2)]
+
+    dwi['stats'] = stats
+
+    # shells are needed to lay out the stages, they only depend on the b-values
+    participant.getShells(dwi)
+
+    numShells = sum(dwi['shells']>50) # use b<50 as b=0 images
+    bShells = dwi['shells'][dwi['shells'] > 50]
+
+    # stages as a graph of the intermediate results they read and write, stages whose
+    # inputs are ready run in parallel (e.g. the overlays next to the tensor fits)
+    nodes = []
+    initial = ('shells',)
+    nodes.append(stagegraph.node('samplingScheme', participant.samplingScheme, (dwi,)))
+    # Denoising to obtain noise-map
+    nodes.append(stagegraph.node('denoise', participant.denoise, (dwi,), (), ('denoised', 'noise')))
+    # b=0 and brain extraction
+    nodes.append(stagegraph.node('brainMask', participant.brainMask, (dwi,),
+                                 ('denoised', 'shells'), ('b0', 'mask', 'diskMask')))
+
+    shellDWIs = []
+    # MultiShell Datasets: perform tensor fit, residuals and fa per shell
+    if numShells < 10 and numShells > 1 and sum(dwi['shells']<=50) > 0:
+        # mean diffusion signal and its spectral metrics for all shells at once
+        nodes.append(stagegraph.node('shellSpectra', participant.shellSpectra, (dwi, bShells),
+                                     ('denoised', 'shells', 'mask'), ('shellMds',)))
+
+        fullBval = np.loadtxt(dwi['bval'])
+        fullBvec = np.loadtxt(dwi['bvec'])
+
+        for bShell in bShells:
+            shell = {}
+            shellStr = "_b" + str(int(bShell))
+            shellDWIs.append(shell)
+            nodes.append(stagegraph.node('shellData' + shellStr, shellAcquisition,
+                                         (dwi, shell, bShell, fullBval, fullBvec),
+                                         ('denoised', 'shells', 'b0', 'mask', 'diskMask', 'shellMds'),
+                                         ('dwi' + shellStr,)))
+            nodes.append(stagegraph.node('getShells' + shellStr, participant.getShells, (shell,),
+                                         ('dwi' + shellStr,), ('shells' + shellStr,)))
+
+            # perform tensor fit, faMap and Residuals
+            nodes.extend(fitStages(shell, shellStr, ('shells' + shellStr,), (), job['tensor_backend']))
+
+            # Create stats-file, Cleanup dwi data at shell-level
+            nodes.append(stagegraph.node('finishShell' + shellStr, finishShell,
+                                         (shell, job['output_dir'],
+                                          None if keep_dir is None else keep_dir + shellStr),
+                                         ('fa' + shellStr, 'mds' + shellStr, 'residuals' + shellStr),
+                                         ('stats' + shellStr,)))
+    else:
+        dwi['shellStr'] = ''
+        # tensor fit, FA maps, MDS map and DTI residuals
+        nodes.extend(fitStages(dwi, '', ('denoised', 'shells'), ('b0', 'mask', 'diskMask'),
+                               job['tensor_backend']))
+
+    # check DWI -> T1 overlay, T1s of the matching session
+    for t1_file in job['t1_files']:
+        t1 = {}
+        t1['file'] = t1_file
+        nodes.append(stagegraph.node('anatOverlay:' + os.path.basename(t1_file).partition('.')[0],
+                                     participant.anatOverlay, (dwi, t1), ('denoised', 'b0', 'diskMask')))
+
+    times = stagegraph.run(nodes, job['stage_threads'], initial)
+
+    # the stats of the acquisition include those of the last shell
+    if shellDWIs:
+        dwi['stats'].update(shellDWIs[-1]['stats'])
+        dwi['stats']['subject_label'] = subject_label
+
+    # stage timeline and critical path of the acquisition
+    timeline = stagegraph.timeline(nodes, times, initial)
+    timeline.to_csv(os.path.join(stats_dir, 'stage_timeline.tsv'), sep="\t", index=False)
+    print("critical path %.1f s of %.1f s: %s"%(timeline['wall_time'][timeline['critical']].sum(),
+                                                 timeline['end'].max(),
+                                                 " -> ".join(timeline['stage'][timeline['critical']])))
+
+    # Create stats-file
+    writeStats(dwi['stats'], stats_dir, job['output_dir'])
+
+    print(cache.volumes.report())
+    runner.configure(job['nthreads'])
+
+    if job['profile']:
+        profiler.write(stats_dir)
+        print(profiler.summary().to_string(index=False))
+        profiler.configure(False)
+
+    # Cleanup dwi-level
+    cleanupData(subject_dir, keep_dir)
+
+    return dwi['stats']
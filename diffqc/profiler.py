@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import resource
+import threading
+import functools
+from glob import glob
+import numpy as np
+import pandas as pd
+
+# opt-in profile of an acquisition: participant stages, external commands and inline figure
+# rendering are recorded as complete events of a Chrome trace (chrome://tracing, Perfetto)
+# and summarized per stage, the group level aggregates the summaries over the cohort
+_enabled = False
+# stages running in parallel threads: CPU time and I/O are taken from the thread of a stage
+# (without helper threads, e.g. of BLAS), the peak memory is of the process and left out
+_concurrent = False
+# enclosing calls per thread, stages of an acquisition may run in parallel threads
+_local = threading.local()
+events = []
+
+PERCENTILES = (5, 25, 50, 75, 95)
+COLUMNS = ('wall_time', 'cpu_time', 'max_rss_mb', 'read_bytes', 'written_bytes')
+
+def configure(enabled, concurrent=False):
+    global _enabled, _concurrent
+    _enabled = enabled
+    _concurrent = concurrent
+
+def stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def reset():
+    del events[:]
+    del stack()[:]
+
+def peakRss():
+    # high-water mark of the resident set since the last resetPeak (Linux), else over the process lifetime
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def resetPeak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except (IOError, OSError):
+        pass
+
+def usage():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return (time.time(), ru.ru_utime + ru.ru_stime, ru.ru_inblock * 512, ru.ru_oublock * 512)
+
+def threadUsage():
+    # usage() of the calling thread (Linux), else only the CPU time (python >= 3.7) or nothing (None)
+    if hasattr(resource, 'RUSAGE_THREAD'):
+        ru = resource.getrusage(resource.RUSAGE_THREAD)
+        return (time.time(), ru.ru_utime + ru.ru_stime, ru.ru_inblock * 512, ru.ru_oublock * 512)
+    cpu = time.thread_time() if hasattr(time, 'thread_time') else None
+    return (time.time(), cpu, None, None)
+
+def difference(before, after):
+    return None if before is None or after is None else after - before
+
+def addEvent(name, category, start, wall, cpu, max_rss_mb, read_bytes, written_bytes, args=None):
+    if not _enabled:
+        return
+    event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+             'ts': int(start * 1e6), 'dur': int(wall * 1e6)}
+    # resources that are not known (None) are left out
+    resources = {'wall_time': wall, 'cpu_time': cpu, 'max_rss_mb': max_rss_mb,
+                 'read_bytes': read_bytes, 'written_bytes': written_bytes}
+    event['args'] = dict((k, v) for (k, v) in resources.items() if v is not None)
+    if args:
+        event['args'].update(args)
+    events.append(event)
+
+def stageArgs(args):
+    # shell of the participant stage, the dwi dict is the first argument
+    if args and isinstance(args[0], dict) and args[0].get('shellStr'):
+        return {'shell': args[0]['shellStr']}
+    return None
+
+def profiled(category, label=stageArgs):
+    # decorator, records a call as an event when profiling is enabled
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            if _concurrent:
+                before = threadUsage()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    after = threadUsage()
+                    addEvent(func.__name__, category, before[0], after[0] - before[0],
+                             difference(before[1], after[1]), None, difference(before[2], after[2]),
+                             difference(before[3], after[3]), label(args))
+
+            # the peak of enclosing calls is kept before the peak is reset for this one
+            peak = peakRss()
+            for frame in stack():
+                frame[0] = max(frame[0], peak)
+            resetPeak()
+            stack().append([0.0])
+            before = usage()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                after = usage()
+                peak = max(stack().pop()[0], peakRss())
+                addEvent(func.__name__, category, before[0], after[0] - before[0], after[1] - before[1],
+                         peak, after[2] - before[2], after[3] - before[3], label(args))
+        return wrapper
+    return decorate
+
+def summary():
+    # one row per event name, resources summed and peak memory maximized over all calls,
+    # NaN where the resource is not recorded
+    if not events:
+        return pd.DataFrame(columns=('category', 'name', 'calls') + COLUMNS)
+    df = pd.DataFrame([dict(e['args'], name=e['name'], category=e['cat']) for e in events])
+    df = df.reindex(columns=['category', 'name'] + list(COLUMNS))
+    df['calls'] = 1
+    total = lambda s: s.sum(min_count=1)
+    df = df.groupby(['category', 'name'], sort=False).agg(
+        {'calls': 'sum', 'wall_time': total, 'cpu_time': total, 'max_rss_mb': 'max',
+         'read_bytes': total, 'written_bytes': total}).reset_index()
+    return df[['category', 'name', 'calls'] + list(COLUMNS)]
+
+def write(stats_dir):
+    if not _enabled:
+        return
+    with open(os.path.join(stats_dir, 'profile_trace.json'), 'w') as fp:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+    summary().to_csv(os.path.join(stats_dir, 'profile_summary.tsv'), sep="\t", index=False)
+
+def cohortPercentiles(output_dir):
+    # percentiles of the per-acquisition stage totals over all profiled acquisitions
+    files = sorted(glob(os.path.join(output_dir, 'qc_stats', 'sub-*', 'profile_summary.tsv')))
+    if not files:
+        return None
+    df = pd.concat([pd.read_csv(f, sep="\t") for f in files], ignore_index=True)
+
+    rows = []
+    for (category, name), stage in df.groupby(['category', 'name'], sort=False):
+        row = {'category': category, 'name': name, 'acquisitions': len(stage)}
+        for column in COLUMNS:
+            # over the acquisitions that recorded the resource
+            recorded = stage[column].dropna()
+            values = np.percentile(recorded, PERCENTILES) if len(recorded) else [np.nan] * len(PERCENTILES)
+            for (p, v) in zip(PERCENTILES, values):
+                row['%s_p%d'%(column, p)] = v
+        rows.append(row)
+    columns = ['category', 'name', 'acquisitions'] + ['%s_p%d'%(c, p) for c in COLUMNS for p in PERCENTILES]
+    table = pd.DataFrame(rows, columns=columns)
+    table.to_csv(os.path.join(output_dir, 'qc_stats', 'profile_percentiles.tsv'), sep="\t", index=False)
+    return table
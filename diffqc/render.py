@@ -0,0 +1,163 @@
+import os
+import traceback
+import threading
+import multiprocessing
+import multiprocessing.connection
+from queue import Empty, Full
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from diffqc import profiler
+
+# figures are rendered by a separate set of worker processes fed through a queue, so the
+# compute path only hands over the arrays a figure needs; without workers figures are
+# rendered inline; a watcher thread reads what the workers report over their own pipes and
+# counts them down as they exit (however they exit), so that nothing waits for workers that
+# died: once none is left, submit renders inline and the watcher renders what is still queued
+_queue = None
+_alive = None
+_workers = []
+_watcher = None
+_stopping = threading.Event()
+# [(path, traceback)] of the figures that failed in the workers or the watcher
+_failures = []
+# seconds between checks of the workers while waiting for the queue
+POLL = 1
+# pyplot state is global, stages running in parallel threads render inline one at a time
+_inlineLock = threading.Lock()
+
+@profiler.profiled('render', lambda args: {'figure': os.path.basename(args[2])})
+def plotToFile(plotFunc, args, path):
+    plotFunc(*args)
+    plt.savefig(path, bbox_inches='tight')
+    plt.close()
+
+def renderInline(plotFunc, args, path):
+    with _inlineLock:
+        plotToFile(plotFunc, args, path)
+
+def renderWorker(queue, reports):
+    # reports (path, None) when a figure is started and (path, traceback or '') when it is finished
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        reports.send((job[2], None))
+        try:
+            plotToFile(*job)
+            reports.send((job[2], ''))
+        except Exception:
+            reports.send((job[2], traceback.format_exc()))
+    reports.close()
+
+def watchWorkers(workers, reports, alive, queue):
+    rendering = {}
+    open_reports = dict(zip(reports, workers))
+    running = dict((worker.sentinel, worker) for worker in workers)
+    while open_reports or running:
+        for ready in multiprocessing.connection.wait(list(open_reports) + list(running)):
+            if ready in running:
+                running.pop(ready)
+                with alive.get_lock():
+                    alive.value -= 1
+                continue
+            try:
+                (path, error) = ready.recv()
+            except EOFError:
+                worker = open_reports.pop(ready)
+                # a figure that was started and not finished
+                if ready in rendering:
+                    worker.join()
+                    _failures.append((rendering.pop(ready), "render worker %d died (exit code %s) while "
+                                      "rendering this figure\n"%(worker.pid, worker.exitcode)))
+                continue
+            if error is None:
+                rendering[ready] = path
+            else:
+                rendering.pop(ready, None)
+                if error:
+                    _failures.append((path, error))
+
+    # no worker left, figures that are still queued or still come are rendered here
+    while True:
+        try:
+            job = queue.get(timeout=POLL)
+        except Empty:
+            if _stopping.is_set():
+                break
+            continue
+        if job is None:
+            continue
+        try:
+            renderInline(*job)
+        except Exception:
+            _failures.append((job[2], traceback.format_exc()))
+
+def start(n_workers):
+    global _queue, _alive, _watcher
+    if n_workers < 1:
+        return
+    # bounded, so that compute workers can't run away from the renderers
+    _queue = multiprocessing.Queue(maxsize=4 * n_workers)
+    _alive = multiprocessing.Value('i', n_workers)
+    _stopping.clear()
+    del _failures[:]
+    reports = []
+    for i in range(n_workers):
+        (reader, writer) = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(target=renderWorker, args=(_queue, writer))
+        worker.start()
+        # only the worker writes, so that the pipe ends when the worker does
+        writer.close()
+        reports.append(reader)
+        _workers.append(worker)
+    _watcher = threading.Thread(target=watchWorkers, args=(list(_workers), reports, _alive, _queue))
+    _watcher.daemon = True
+    _watcher.start()
+
+def getQueue():
+    return (_queue, _alive)
+
+def attach(queue):
+    # used as initializer of compute worker processes, with what getQueue returned
+    global _queue, _alive
+    (_queue, _alive) = queue
+
+def submit(plotFunc, args, path):
+    # once all render workers are gone (e.g. killed), figures are rendered inline
+    while _queue is not None and _alive.value > 0:
+        try:
+            _queue.put((plotFunc, args, path), timeout=POLL)
+            return
+        except Full:
+            pass
+    renderInline(plotFunc, args, path)
+
+def stop():
+    # wait until all submitted figures are written; returns [(path, traceback)] of the figures
+    # that failed (inline figures fail the stage that submits them)
+    global _queue, _alive, _watcher
+    if _queue is None:
+        return []
+    _stopping.set()
+    # one end marker per worker that is still alive
+    sentinels = 0
+    while sentinels < _alive.value:
+        try:
+            _queue.put(None, timeout=POLL)
+            sentinels += 1
+        except Full:
+            pass
+    _watcher.join()
+    for worker in _workers:
+        worker.join()
+        if worker.exitcode != 0:
+            print("render worker %d died (exit code %s)"%(worker.pid, worker.exitcode))
+    del _workers[:]
+    failures = list(_failures)
+    del _failures[:]
+    _queue = None
+    _alive = None
+    _watcher = None
+    return failures
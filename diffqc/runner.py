@@ -0,0 +1,112 @@
+import os
+import time
+import shlex
+import subprocess
+import threading
+import multiprocessing
+
+from diffqc import profiler
+
+# external commands: MRtrix thread count, per-acquisition log file, resource records and
+# a limit on how many heavy tools run at once over all worker processes
+MRTRIX_TOOLS = ('dwidenoise', 'dwiextract', 'dwi2tensor', 'tensor2metric', 'mrconvert')
+HEAVY_TOOLS = ('dwidenoise',)
+
+_nthreads = None
+_logFile = None
+_limiter = None
+_logLock = threading.Lock()
+records = []
+
+def configure(nthreads=None, log_file=None):
+    global _nthreads, _logFile
+    _nthreads = nthreads
+    _logFile = log_file
+
+def createLimiter(n):
+    if n is None or n < 1:
+        return None
+    return multiprocessing.BoundedSemaphore(n)
+
+def setLimiter(limiter):
+    global _limiter
+    _limiter = limiter
+
+def reset():
+    del records[:]
+
+def writeLog(log, data):
+    if log is None:
+        return
+    with _logLock:
+        log.write(data)
+        log.flush()
+
+def run(command, env={}):
+    args = shlex.split(command)
+    tool = os.path.basename(args[0])
+    if _nthreads is not None and tool in MRTRIX_TOOLS:
+        args += ['-nthreads', str(_nthreads)]
+
+    merged_env = dict(os.environ)
+    merged_env.update(env)
+
+    limiter = _limiter if tool in HEAVY_TOOLS else None
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        log = open(_logFile, 'ab') if _logFile else None
+        try:
+            writeLog(log, ("$ " + " ".join(shlex.quote(a) for a in args) + "\n").encode('utf-8'))
+            start = time.time()
+            process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, env=merged_env)
+            # output is streamed to the log (a hung or killed tool leaves what it printed), in whole
+            # lines as commands of parallel stages share the log; MRtrix prefixes them with the tool
+            pending = b''
+            while True:
+                block = process.stdout.read1(65536)
+                if not block:
+                    break
+                pending += block
+                end = max(pending.rfind(b'\n'), pending.rfind(b'\r')) + 1
+                if end > 0:
+                    writeLog(log, pending[:end])
+                    pending = pending[end:]
+            process.stdout.close()
+            if pending:
+                writeLog(log, pending + b'\n')
+
+            # wait4 reports the resources of this child only
+            _, status, usage = os.wait4(process.pid, 0)
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+
+            record = {}
+            record['command'] = command
+            record['tool'] = tool
+            record['returncode'] = process.returncode
+            record['wall_time'] = time.time() - start
+            record['cpu_time'] = usage.ru_utime + usage.ru_stime
+            record['max_rss_mb'] = usage.ru_maxrss / 1024.0
+            record['read_bytes'] = usage.ru_inblock * 512
+            record['written_bytes'] = usage.ru_oublock * 512
+            records.append(record)
+            profiler.addEvent(tool, 'command', start, record['wall_time'], record['cpu_time'],
+                              record['max_rss_mb'], record['read_bytes'], record['written_bytes'],
+                              {'command': command})
+
+            writeLog(log, ("# %s: return code %d, wall %.1f s, cpu %.1f s, max rss %.1f MB\n\n"%(
+                tool, record['returncode'], record['wall_time'], record['cpu_time'],
+                record['max_rss_mb'])).encode('utf-8'))
+        finally:
+            if log is not None:
+                log.close()
+    finally:
+        if limiter is not None:
+            limiter.release()
+
+    if process.returncode != 0:
+        raise Exception("Non zero return code: %d"%process.returncode)
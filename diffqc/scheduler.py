@@ -0,0 +1,84 @@
+import os
+import traceback
+import collections
+import multiprocessing
+
+from diffqc import pipeline
+from diffqc import render
+from diffqc import runner
+from diffqc import claims
+
+def runJob(job):
+    # acquisitions claimed by another worker are skipped (None)
+    if job['claim'] and not claims.claim(job, job['claim_timeout']):
+        return None
+    # isolate failures, a broken acquisition must not stop the batch
+    try:
+        result = (job, pipeline.processAcquisition(job), None)
+    except Exception:
+        result = (job, None, traceback.format_exc())
+    if job['claim']:
+        claims.release(job, result[2] is not None)
+    return result
+
+def runJobGroup(group):
+    return [runJob(job) for job in group]
+
+def groupJobs(jobs):
+    # acquisitions sharing their T1s run one after the other in the same worker, so that the
+    # normalized T1 of participant.normalizedT1 is reused; acquisitions without T1 stand alone
+    groups = collections.OrderedDict()
+    for i, job in enumerate(jobs):
+        key = tuple(job['t1_files']) if job['t1_files'] else i
+        groups.setdefault(key, []).append(job)
+    return list(groups.values())
+
+def initWorker(render_queue, limiter):
+    render.attach(render_queue)
+    runner.setLimiter(limiter)
+
+def runJobs(jobs, n_procs=1, max_heavy_procs=0):
+    results = []
+    groups = groupJobs(jobs)
+    if n_procs <= 1 or len(groups) <= 1:
+        for job in jobs:
+            results.append(runJob(job))
+        return [r for r in results if r is not None]
+
+    # workers are kept alive over jobs so that per-process memos (e.g. shells per protocol) are reused
+    pool = multiprocessing.Pool(processes=min(n_procs, len(groups)),
+                                initializer=initWorker,
+                                initargs=(render.getQueue(), runner.createLimiter(max_heavy_procs)))
+    try:
+        for groupResults in pool.imap_unordered(runJobGroup, groups):
+            results.extend(r for r in groupResults if r is not None)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def ownsFigure(job, path):
+    fig_dir = os.path.dirname(os.path.normpath(path))
+    return (os.path.dirname(fig_dir) == os.path.normpath(os.path.join(job['output_dir'], 'qc_figures'))
+            and pipeline.isAcquisitionFolder(job, os.path.basename(fig_dir)))
+
+def addRenderFailures(results, failures):
+    # figures rendered in the background fail after their acquisition is finished (and released),
+    # the acquisition is failed afterwards
+    marked = []
+    for (job, stats, err) in results:
+        errors = ["FAILED rendering " + path + "\n" + tb for (path, tb) in failures if ownsFigure(job, path)]
+        if errors and err is None:
+            err = "\n".join(errors)
+            if job['claim']:
+                claims.fail(job)
+        marked.append((job, stats, err))
+    return marked
+
+def reportFailures(results):
+    failed = [r for r in results if r[2] is not None]
+    for (job, _, err) in failed:
+        print("FAILED sub-" + job['subject_label'] + ": " + job['file'] + "\n" + err)
+    if failed:
+        print("%d of %d acquisitions failed"%(len(failed), len(results)))
+    return failed
@@ -0,0 +1,76 @@
+import numpy as np
+
+try:
+    # real input transforms in single precision, threaded
+    import scipy.fft as _fft
+    _threaded = True
+except ImportError:
+    _fft = np.fft
+    _threaded = False
+
+# sharpness and blur measures of 3D maps from one real FFT, several maps (e.g. one per shell)
+# are stacked along the first axis and transformed at once
+METRICS = ('sharpness', 'hf_energy', 'spectral_slope')
+
+def rfft3(maps, workers=-1):
+    # workers=-1 uses all CPUs, numpy.fft (scipy < 1.4) is single-threaded
+    maps = np.asarray(maps, dtype=np.float32)
+    if _threaded:
+        return _fft.rfftn(maps, axes=(1, 2, 3), workers=workers)
+    return _fft.rfftn(maps, axes=(1, 2, 3))
+
+def halfWeights(n):
+    # number of coefficients of the full spectrum a bin of the last rfft axis stands for
+    w = np.full(n // 2 + 1, 2.0)
+    w[0] = 1
+    if n % 2 == 0:
+        w[-1] = 1
+    return w
+
+def radialFrequency(shape):
+    # distance of the rfft bins from DC, 1 is the Nyquist frequency along an axis
+    fx = np.fft.fftfreq(shape[0])[:, np.newaxis, np.newaxis]
+    fy = np.fft.fftfreq(shape[1])[np.newaxis, :, np.newaxis]
+    fz = np.fft.rfftfreq(shape[2])[np.newaxis, np.newaxis, :]
+    return 2 * np.sqrt(fx**2 + fy**2 + fz**2)
+
+def sharpnessMetrics(maps, workers=-1, hf_cutoff=0.5, nbins=16):
+    # sharpness: fraction of coefficients above max/1000 of the full spectrum,
+    # hf_energy: share of the non-DC energy above hf_cutoff,
+    # spectral_slope: slope of log power over log frequency of the radial spectrum up to Nyquist
+    maps = np.asarray(maps)
+    single = maps.ndim == 3
+    if single:
+        maps = maps[np.newaxis]
+    shape = maps.shape[1:]
+
+    A = np.abs(rfft3(maps, workers))
+    w = halfWeights(shape[2])
+    r = radialFrequency(shape)
+
+    thresh = np.max(A, axis=(1, 2, 3)) / 1000
+    sharpness = np.sum((A > thresh[:, np.newaxis, np.newaxis, np.newaxis]) * w, axis=(1, 2, 3)) / float(np.prod(shape))
+
+    power = np.square(A, dtype=np.float64)
+    power *= w
+    total = np.sum(power * (r > 0), axis=(1, 2, 3))
+    high = np.sum(power * (r > hf_cutoff), axis=(1, 2, 3))
+    hf_energy = np.zeros(total.shape)
+    np.divide(high, total, out=hf_energy, where=total>0)
+
+    ring = np.ceil(r * nbins).astype(int).ravel()
+    inRange = np.logical_and(ring >= 1, ring <= nbins)
+    ring = ring[inRange]
+    binCount = np.bincount(ring, weights=np.broadcast_to(w, r.shape).ravel()[inRange], minlength=nbins + 1)[1:]
+    logFreq = np.log((np.arange(nbins) + 0.5) / nbins)
+    slope = np.zeros(len(maps))
+    for i in range(len(maps)):
+        binPower = np.bincount(ring, weights=power[i].ravel()[inRange], minlength=nbins + 1)[1:]
+        valid = np.logical_and(binCount > 0, binPower > 0)
+        if np.sum(valid) > 1:
+            slope[i] = np.polyfit(logFreq[valid], np.log(binPower[valid] / binCount[valid]), 1)[0]
+
+    metrics = {'sharpness': sharpness, 'hf_energy': hf_energy, 'spectral_slope': slope}
+    if single:
+        return dict((k, float(v[0])) for k, v in metrics.items())
+    return metrics
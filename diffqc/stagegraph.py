@@ -0,0 +1,96 @@
+import time
+import concurrent.futures
+import pandas as pd
+
+# participant stages as a graph: every node declares the resources (names) it reads and
+# writes, a node runs as soon as all its inputs are written, independent nodes run
+# concurrently in threads (external commands and most NumPy work release the GIL);
+# nodes are declared in an order that is valid when run one after the other
+
+def node(name, func, args=(), inputs=(), outputs=()):
+    return {'name': name, 'func': func, 'args': tuple(args),
+            'inputs': tuple(inputs), 'outputs': tuple(outputs)}
+
+def producers(nodes, initial=()):
+    # node index writing each resource, inputs must be written by an earlier node (so there are no cycles)
+    written = dict((resource, None) for resource in initial)
+    deps = []
+    for i, n in enumerate(nodes):
+        for resource in n['inputs']:
+            if resource not in written:
+                raise Exception("stage %s reads %s, which no earlier stage writes"%(n['name'], resource))
+        deps.append(sorted(set(written[r] for r in n['inputs'] if written[r] is not None)))
+        for resource in n['outputs']:
+            if resource in written:
+                raise Exception("stage %s writes %s, which is already written"%(n['name'], resource))
+            written[resource] = i
+    return deps
+
+def runNode(n):
+    start = time.time()
+    n['func'](*n['args'])
+    return (start, time.time())
+
+def run(nodes, n_threads=1, initial=()):
+    # runs all nodes, the first failure stops scheduling further nodes and is raised once the
+    # running ones are finished; returns (start, end) per node
+    deps = producers(nodes, initial)
+    times = [None] * len(nodes)
+    if n_threads <= 1:
+        for i, n in enumerate(nodes):
+            times[i] = runNode(n)
+        return times
+
+    waiting = set(range(len(nodes)))
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        while waiting or running:
+            if error is None:
+                # in order of declaration, so the serial order is kept where nothing overlaps
+                for i in sorted(waiting):
+                    if all(times[d] is not None for d in deps[i]):
+                        waiting.discard(i)
+                        running[executor.submit(runNode, nodes[i])] = i
+            else:
+                waiting.clear()
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    times[i] = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    return times
+
+def criticalPath(nodes, times, initial=()):
+    # longest chain of dependent nodes by wall time, what bounds the acquisition with unlimited threads
+    deps = producers(nodes, initial)
+    finish = []
+    previous = []
+    for i in range(len(nodes)):
+        before = max(deps[i], key=lambda d: finish[d]) if deps[i] else None
+        previous.append(before)
+        finish.append((times[i][1] - times[i][0]) + (finish[before] if before is not None else 0.0))
+    path = []
+    i = max(range(len(nodes)), key=lambda j: finish[j]) if nodes else None
+    while i is not None:
+        path.append(i)
+        i = previous[i]
+    return path[::-1]
+
+def timeline(nodes, times, initial=()):
+    # one row per node: start and end relative to the first node, wall time and critical path membership
+    critical = set(criticalPath(nodes, times, initial))
+    t0 = min(t[0] for t in times) if times else 0.0
+    rows = []
+    for i, n in enumerate(nodes):
+        rows.append({'stage': n['name'], 'start': times[i][0] - t0, 'end': times[i][1] - t0,
+                     'wall_time': times[i][1] - times[i][0], 'critical': i in critical,
+                     'inputs': ','.join(n['inputs'])})
+    return pd.DataFrame(rows, columns=['stage', 'start', 'end', 'wall_time', 'critical', 'inputs'])
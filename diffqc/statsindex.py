@@ -0,0 +1,73 @@
+import os
+import json
+import sqlite3
+from glob import glob
+import pandas as pd
+
+# append-only index of the per-acquisition stats.tsv files, participant runs record their rows
+# and the group level only (re-)reads files that are new or changed since they were indexed
+
+def indexPath(output_dir):
+    return os.path.join(output_dir, 'qc_stats', 'stats_index.sqlite')
+
+def connect(output_dir):
+    if not os.path.isdir(os.path.dirname(indexPath(output_dir))):
+        os.makedirs(os.path.dirname(indexPath(output_dir)))
+    db = sqlite3.connect(indexPath(output_dir), timeout=600)
+    db.execute("CREATE TABLE IF NOT EXISTS stats (path TEXT PRIMARY KEY, mtime REAL, row TEXT)")
+    return db
+
+def readStats(stats_file):
+    # values are kept as written by the participant level
+    df = pd.read_csv(stats_file, sep="\t", dtype=str, keep_default_na=False)
+    return [list(df.columns), df.values.tolist()]
+
+def record(output_dir, stats_file):
+    # best effort: on a shared file system the index can be locked or not lockable at all,
+    # a row that is missing is added by sync() at the group level
+    try:
+        db = connect(output_dir)
+        try:
+            with db:
+                db.execute("INSERT OR REPLACE INTO stats VALUES (?, ?, ?)",
+                           (os.path.relpath(stats_file, output_dir), os.path.getmtime(stats_file),
+                            json.dumps(readStats(stats_file))))
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        print("not indexed %s: %s"%(stats_file, e))
+
+def sync(output_dir):
+    # bring the index up to date with the stats files on disk
+    files = {}
+    for stats_file in glob(os.path.join(output_dir, 'qc_stats', 'sub-*', "stats.tsv")):
+        files[os.path.relpath(stats_file, output_dir)] = os.path.getmtime(stats_file)
+
+    db = connect(output_dir)
+    try:
+        indexed = dict(db.execute("SELECT path, mtime FROM stats"))
+        changed = [path for path in files if indexed.get(path) != files[path]]
+        removed = [path for path in indexed if path not in files]
+        with db:
+            db.executemany("INSERT OR REPLACE INTO stats VALUES (?, ?, ?)",
+                           [(path, files[path], json.dumps(readStats(os.path.join(output_dir, path))))
+                            for path in changed])
+            db.executemany("DELETE FROM stats WHERE path = ?", [(path,) for path in removed])
+    finally:
+        db.close()
+    return (len(changed), len(removed))
+
+def table(output_dir):
+    # all indexed rows as one DataFrame, columns in order of first appearance
+    db = connect(output_dir)
+    try:
+        entries = [json.loads(row) for (row,) in db.execute("SELECT row FROM stats ORDER BY path")]
+    finally:
+        db.close()
+
+    columns = []
+    records = []
+    for (cols, rows) in entries:
+        columns.extend(c for c in cols if c not in columns)
+        records.extend(dict(zip(cols, values)) for values in rows)
+    return pd.DataFrame.from_records(records, columns=columns)
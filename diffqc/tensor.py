@@ -0,0 +1,93 @@
+import numpy as np
+
+def gradientsToScanner(bvec, affine):
+    # FSL bvecs are given in image coordinates with the first axis flipped for a positive determinant,
+    # tensors and eigenvectors are reported in scanner coordinates like MRtrix does
+    R = affine[:3,:3] / np.linalg.norm(affine[:3,:3], axis=0)
+    g = np.array(bvec, dtype=np.float64)
+    if np.linalg.det(affine[:3,:3]) > 0:
+        g[0] = -g[0]
+    g = R.dot(g)
+    norm = np.linalg.norm(g, axis=0)
+    g[:, norm > 0] /= norm[norm > 0]
+    return g
+
+def designMatrix(bval, g):
+    # log-linear model: ln S = B * [Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, ln S0]
+    B = np.zeros((bval.size, 7))
+    B[:,0] = -bval * g[0]**2
+    B[:,1] = -bval * g[1]**2
+    B[:,2] = -bval * g[2]**2
+    B[:,3] = -2 * bval * g[0] * g[1]
+    B[:,4] = -2 * bval * g[0] * g[2]
+    B[:,5] = -2 * bval * g[1] * g[2]
+    B[:,6] = 1
+    return B
+
+def fitWLLS(S, B, iterations=2):
+    # batched (iteratively re-)weighted linear least squares, S holds one voxel per row
+    S = S.astype(np.float64)
+    floor = 1e-3 * np.max(S, axis=1, keepdims=True)
+    y = np.log(np.maximum(S, np.maximum(floor, np.finfo(np.float64).tiny)))
+
+    x = y.dot(np.linalg.pinv(B).T)
+    for it in range(iterations):
+        # weights are the squared predicted signal, scaled per voxel to avoid overflow
+        logPred = x.dot(B.T)
+        w = np.exp(2 * (logPred - np.max(logPred, axis=1, keepdims=True)))
+        BtWB = np.einsum('ni,vn,nj->vij', B, w, B)
+        BtWy = np.einsum('ni,vn->vi', B, w * y)
+        try:
+            x = np.linalg.solve(BtWB, BtWy[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            # degenerate weights, keep the previous estimate
+            break
+    return x
+
+def tensorMetrics(params):
+    # fractional anisotropy and FA-modulated primary eigenvector (as tensor2metric -vector)
+    D = np.zeros((params.shape[0], 3, 3))
+    D[:,0,0] = params[:,0]
+    D[:,1,1] = params[:,1]
+    D[:,2,2] = params[:,2]
+    D[:,0,1] = D[:,1,0] = params[:,3]
+    D[:,0,2] = D[:,2,0] = params[:,4]
+    D[:,1,2] = D[:,2,1] = params[:,5]
+
+    evals, evecs = np.linalg.eigh(D)
+    md = np.mean(evals, axis=1, keepdims=True)
+    num = np.sum((evals - md)**2, axis=1)
+    den = np.sum(evals**2, axis=1)
+    fa = np.zeros(num.shape)
+    np.divide(1.5 * num, den, out=fa, where=den > 0)
+    fa = np.sqrt(fa)
+
+    ev1 = evecs[:,:,2] * fa[:, np.newaxis]
+    return (fa, ev1)
+
+def fitTensor(data, bval, g, mask, chunk=20000, dtype=np.float32):
+    # fit all voxels inside mask, voxels outside the mask are not fitted and keep
+    # their measured signal as prediction, i.e. they have zero residuals; the prediction
+    # is kept in dtype, the fit itself runs in float64
+    B = designMatrix(bval, g)
+    S = data[mask]
+
+    params = np.zeros((S.shape[0], 7))
+    predicted = np.array(data, dtype=dtype)
+    pred = np.zeros(S.shape, dtype=dtype)
+    for start in range(0, S.shape[0], chunk):
+        params[start:start+chunk] = fitWLLS(S[start:start+chunk], B)
+        pred[start:start+chunk] = np.exp(params[start:start+chunk].dot(B.T))
+    predicted[mask] = pred
+
+    fa, ev1 = tensorMetrics(params)
+
+    fit = {}
+    fit['predicted'] = predicted
+    fit['tensor'] = np.zeros(mask.shape + (6,))
+    fit['tensor'][mask] = params[:,:6]
+    fit['fa'] = np.zeros(mask.shape)
+    fit['fa'][mask] = fa
+    fit['ev1'] = np.zeros(mask.shape + (3,))
+    fit['ev1'][mask] = ev1
+    return fit
@@ -1,13 +1,7 @@
 #!/usr/bin/env python3.5
 import argparse
 import os
-import nibabel as nib
-import numpy as np
-from glob import glob
-from diffqc import *
-import shutil
-import pandas as pd
-import collections
+import sys
 
 __version__ = open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 'version')).read()
@@ -33,14 +27,74 @@ parser.add_argument('--skip_bids_validator', help='Whether or not to perform BID
                    action='store_true')
 parser.add_argument('--keep_data', help='Keep intermediate data (e.g. fa maps)',
                    action='store_true')
+parser.add_argument('--n_procs', help='Number of DWI acquisitions processed in parallel',
+                   type=int, default=1)
+parser.add_argument('--cache_mem', help='Memory ceiling in MB for decoded volumes kept in memory per worker',
+                   type=int, default=4096)
+parser.add_argument('--tensor_backend', help='Tensor fit with MRtrix dwi2tensor or in-process with numpy',
+                   choices=['mrtrix', 'numpy'], default='mrtrix')
+parser.add_argument('--n_render_procs', help='Number of processes writing figures in the background, '
+                   '0 renders figures inline',
+                   type=int, default=1)
+parser.add_argument('--artifact_cache', help='Directory to keep MRtrix stage outputs across runs, '
+                   'keyed by input content, command line and tool version')
+parser.add_argument('--artifact_cache_size', help='Size limit of the artifact cache in MB',
+                   type=int, default=50000)
+parser.add_argument('--artifact_cache_age', help='Remove artifact cache entries unused for this many days',
+                   type=float, default=30)
+parser.add_argument('--nthreads', help='Number of threads passed to MRtrix commands (-nthreads) and used by '
+                   'the FFTs of the sharpness measures, all CPUs if not set',
+                   type=int)
+parser.add_argument('--max_heavy_procs', help='Maximum number of dwidenoise processes running at once '
+                   'over all parallel workers, 0 for no limit',
+                   type=int, default=0)
+parser.add_argument('--report_page_size', help='Number of subject folders per page of the group report',
+                   type=int, default=50)
+parser.add_argument('--max_memory', help='Memory budget in MB for the working arrays of brain masking and '
+                   'tensor residuals, larger data is processed in slabs of slices; the 4D input and predicted '
+                   'data are not included, they are only read per slab when mapped from uncompressed '
+                   'float32 intermediates (e.g. with --work_dir)',
+                   type=int)
+parser.add_argument('--profile', help='Record time, memory and I/O of every stage and external command, '
+                   'written as Chrome trace and summary per acquisition; with --stage_threads > 1 CPU time '
+                   'and I/O of a stage are those of its thread and its peak memory is not recorded',
+                   action='store_true')
+parser.add_argument('--mask_downsample', help='Estimate the brain mask on a grid downsampled by this factor, '
+                   '1 for full resolution',
+                   type=int, default=1)
+parser.add_argument('--dtype', help='Floating point precision of the image data in the participant stages, '
+                   'statistics are accumulated in float64 either way',
+                   choices=['float32', 'float64'], default='float32')
+parser.add_argument('--work_dir', help='Scratch directory (e.g. local disk or tmpfs) for uncompressed '
+                   'intermediate images, with --keep_data they are compressed into output_dir')
+parser.add_argument('--stage_threads', help='Number of threads running independent stages of an acquisition '
+                   'at once (e.g. T1 overlays next to the tensor fits), 1 runs the stages one after the other',
+                   type=int, default=1)
+parser.add_argument('--shard', help='Process only shard i of N of the acquisitions (i/N, i from 0 to N-1), '
+                   'e.g. the array task id of a cluster job')
+parser.add_argument('--claim', help='Claim each acquisition with a lock file in output_dir/qc_locks before '
+                   'processing it, so participant runs sharing the output_dir never process one twice; '
+                   'finished ones are skipped until their markers are removed',
+                   action='store_true')
+parser.add_argument('--claim_timeout', help='Treat locks older than this many hours as left by a worker '
+                   'that died (locks of dead processes on the same host are detected without it)',
+                   type=float)
 parser.add_argument('-v', '--version', action='version',
                     version='BIDS-App example version {}'.format(__version__))
 
 
 args = parser.parse_args()
 
+# modules are imported for the level that runs only, --help and --version need none of them
+# and the group level none of the imaging stack (see benchmarks/import_time.py)
+from diffqc import bidsindex
+from diffqc import runner
+
 if not args.skip_bids_validator:
-    helper.run('bids-validator %s'%args.bids_dir)
+    runner.run('bids-validator %s'%args.bids_dir)
+
+# one walk over the dataset, later runs only list folders again that changed
+bids = bidsindex.load(args.bids_dir, os.path.join(args.output_dir, 'bids_index.json'))
 
 subjects_to_analyze = []
 # only for a subset of subjects
@@ -48,242 +102,88 @@ if args.participant_label:
     subjects_to_analyze = args.participant_label
 # for all subjects
 else:
-    subject_dirs = glob(os.path.join(args.bids_dir, "sub-*"))
-    subjects_to_analyze = [subject_dir.split("-")[-1] for subject_dir in subject_dirs]
+    subjects_to_analyze = bids.subjects()
 
 # running participant level
 if args.analysis_level == "participant":
-    # find all DWI files and run denoising and tensor / residual calculation
-    for subject_label in subjects_to_analyze:
-
-        print("processing sub-" + subject_label + "\n")
-
-        # loop over DWI-Files
-        for dwi_file in glob(os.path.join(args.bids_dir, "sub-%s"%subject_label,
-                                          "dwi", "*_dwi.nii*")) + glob(os.path.join(args.bids_dir,"sub-%s"%subject_label,"ses-*","dwi", "*_dwi.nii*")):
-
-            # create subj dir in qc_data & qc_figures folders
-            subject_dir = os.path.join(args.output_dir, 'qc_data', 'sub-' + subject_label)
-            fig_dir = os.path.join(args.output_dir, 'qc_figures', 'sub-' + subject_label)
-            stats_dir = os.path.join(args.output_dir, 'qc_stats', 'sub-' + subject_label)
-
-            # check session
-            if dwi_file.split("ses-")[-1] != dwi_file:
-                ses = 'ses-' + dwi_file.split("ses-")[-1].split("_")[0]
-                subject_dir = subject_dir + '_' + ses
-                fig_dir = fig_dir + '_' + ses
-                stats_dir = stats_dir + '_' + ses
-
-            # check acquisition
-            if dwi_file.split("acq-")[-1] != dwi_file:
-                acq = 'acq-' + dwi_file.split("acq-")[-1].split("_")[0]
-                subject_dir = subject_dir + '_' + acq
-                fig_dir = fig_dir + '_' + acq
-                stats_dir = stats_dir + '_' + acq
-
-            # create output folder
-            if not os.path.isdir(subject_dir):
-                os.makedirs(subject_dir)
-            if not os.path.isdir(fig_dir):
-                os.makedirs(fig_dir)
-            if not os.path.isdir(stats_dir):
-                os.makedirs(stats_dir)
-
-            # add acquisition directory
-            dwi = {}
-            dwi['subject_label'] = subject_label
-            dwi['fig_dir'] = fig_dir
-            dwi['data_dir'] = subject_dir
-            dwi['stats_dir'] = stats_dir
-            dwi['file'] = dwi_file
-            dwi['bval'] = dwi['file'].replace("_dwi.nii.gz", "_dwi.bval")
-            dwi['bval'] = dwi['bval'].replace("_dwi.nii", "_dwi.bval")
-            dwi['bvec'] = dwi['file'].replace("_dwi.nii.gz", "_dwi.bvec")
-            dwi['bvec'] = dwi['bvec'].replace("_dwi.nii", "_dwi.bvec")
-
-            # Get Header and flip_sign
-            img = nib.load(dwi['file'])
-
-            # np.set_printoptions(precision=2, suppress=True)
-            # print(np.array(img.get_affine()))
-
-            (M, perm, flip_sign) = helper.fixImageHeader(img)
-
-            voxSize = img.header['pixdim'][1:4]
-
-            # print(M)
-            # print(perm)
-            # print(flip_sign)
-
-            dwi['M'] = M
-            dwi['perm'] = perm
-            dwi['flip_sign'] = flip_sign
-            dwi['voxSize'] = voxSize[perm]
-            stats = collections.OrderedDict()
-            stats['subject_label'] = subject_label
-            stats['voxel_size'] = [np.round(voxSize, decimals=2)]
-
-            dwi['stats'] = stats
-
-            # Get DWI sampling scheme
-            participant.samplingScheme(dwi)
-
-            # get nr of shells and directions
-            participant.getShells(dwi)
-
-
-
-            # Denoising to obtain noise-map
-            participant.denoise(dwi)
-
-            # # Step 2: Gibbs ringing removal (if available)
-            # if unring_cmd:
-            #     run.command(unring_cmd + ' dwi_denoised.nii dwi_unring' + fsl_suffix + ' -n 100')
-            #     file.delTemporary('dwi_denoised.nii')
-            #     unring_output_path = fsl.findImage('dwi_unring')
-            #     run.command('mrconvert ' + unring_output_path + ' dwi_unring.mif -json_import input.json')
-            #     file.delTemporary(unring_output_path)
-            #     file.delTemporary('input.json')
-
-            # b=0 and brain extraction
-            participant.brainMask(dwi)
-
+    from diffqc import pipeline
+    from diffqc import scheduler
+    from diffqc import render
+    from diffqc import artifacts
+    from diffqc import claims
 
-            numShells = sum(dwi['shells']>50) # use b<50 as b=0 images
-            bShells = dwi['shells'][dwi['shells'] > 50]
-            # MultiShell Datasets: perform tensor fit, residuals and fa per shell
-            if numShells < 10 and numShells > 1 and sum(dwi['shells']<=50) > 0:
-                # backup MultiShell Files in Config
-                origDWI = dwi.copy()
-
-                for i in range(numShells):
-                    bShell = bShells[i]
-                    dwi['shellStr'] = "_b" + str(int(bShell))
-
-                    dwi['data_dir'] = origDWI['data_dir'] + dwi['shellStr']
-                    dwi['fig_dir'] = origDWI['fig_dir'] + dwi['shellStr']
-                    dwi['stats_dir'] = origDWI['stats_dir'] + dwi['shellStr']
-
-                    dwi['stats']['subject_label'] = origDWI['subject_label'] + dwi['shellStr']
-
-                    # create output folder
-                    if not os.path.isdir(dwi['data_dir']):
-                        os.makedirs(dwi['data_dir'])
-                    if not os.path.isdir(dwi['fig_dir']):
-                        os.makedirs(dwi['fig_dir'])
-                    if not os.path.isdir(dwi['stats_dir']):
-                        os.makedirs(dwi['stats_dir'])
-
-                    dwi['denoised'] = origDWI['denoised'].replace(origDWI['data_dir'], dwi['data_dir'])
-                    dwi['bval'] = dwi['denoised'].replace('.nii.gz', '.bval')
-                    dwi['bvec'] = dwi['denoised'].replace('.nii.gz', '.bvec')
-
-                    # extract shell from _denoise
-                    cmd = "dwiextract -shells 0,%s -fslgrad %s %s -export_grad_fsl %s %s %s %s -force"%(str(int(bShell)),
-                                                               origDWI['bvec'],
-                                                               origDWI['bval'],
-                                                               dwi['bvec'],
-                                                               dwi['bval'],
-                                                               origDWI['denoised'],
-                                                               dwi['denoised'])
-                    # print(cmd)
-                    helper.run(cmd)
-
-                    participant.getShells(dwi)
-
-                    # perform tensor fit, faMap and Residuals
-                    participant.dtiFit(dwi)
-                    participant.faMap(dwi)
-                    participant.mdsMap(dwi)
-                    participant.tensorResiduals(dwi)
-
-                    # Create stats-file
-                    df = pd.DataFrame([])
-                    df = df.append(pd.DataFrame(dwi['stats'], columns=dwi['stats'].keys()))
-
-                    stats_file = os.path.join(dwi['stats_dir'], "stats.tsv")
-                    df.to_csv(stats_file, sep="\t", index=False)
-
-                    # Cleanup dwi data at shell-level
-                    if not args.keep_data:
-                        shutil.rmtree(dwi['data_dir'])
-
-                # restore MultiShell Files in Config
-                dwi = origDWI.copy()
-                dwi['stats']['subject_label'] = origDWI['subject_label']
-            else:
-                dwi['shellStr'] = ''
-                # perform tensor fit
-                participant.dtiFit(dwi)
-
-                # Create FA maps
-                participant.faMap(dwi)
-
-                # Calculate MDS map
-                participant.mdsMap(dwi)
-
-                # Calc DTI residuals
-                participant.tensorResiduals(dwi)
-
-            # check DWI -> T1 overlay
-            for t1_file in glob(os.path.join(args.bids_dir, "sub-%s"%subject_label,
-                                              "anat", "*_T1w.nii*")) + glob(os.path.join(args.bids_dir,"sub-%s"%subject_label,"ses-*","anat", "*_T1w.nii*")):
-
-                # check if T1 is from the correct session
-                if dwi_file.split("ses-")[-1] != dwi_file:
-                    ses = 'ses-' + dwi_file.split("ses-")[-1].split("_")[0]
-                    ses_t1 = 'ses-' + t1_file.split("ses-")[-1].split("_")[0]
-                    if ses != ses_t1:
-                        # skip t1 file if sessions don't match!
-                        t1_file = ''
-
-                if (t1_file):
-                    t1 = {}
-                    t1['file'] = t1_file
-                    participant.anatOverlay(dwi, t1)
-
-
-            # Create stats-file
-            df = pd.DataFrame([])
-            df = df.append(pd.DataFrame(dwi['stats'], columns=dwi['stats'].keys()))
-
-            stats_file = os.path.join(stats_dir, "stats.tsv")
-            df.to_csv(stats_file, sep="\t", index=False)
-
-            # Cleanup dwi-level
-            if not args.keep_data:
-                shutil.rmtree(subject_dir)
-
-    # Cleanup top-level
-    if not args.keep_data:
-        shutil.rmtree(os.path.join(args.output_dir, 'qc_data'))
+    # find all DWI files and run denoising and tensor / residual calculation
+    jobs = pipeline.acquisitionJobs(bids, args.output_dir,
+                                    subjects_to_analyze, args.keep_data,
+                                    args.cache_mem, args.tensor_backend,
+                                    args.artifact_cache, args.nthreads,
+                                    args.max_memory, args.profile,
+                                    args.mask_downsample, args.dtype,
+                                    args.work_dir, args.claim,
+                                    args.claim_timeout, args.stage_threads)
+    if args.shard:
+        jobs = claims.shard(jobs, *claims.parseShard(args.shard))
+    if args.artifact_cache:
+        artifacts.configure(args.artifact_cache, args.artifact_cache_size,
+                            args.artifact_cache_age).evict()
+
+    render.start(args.n_render_procs)
+    try:
+        results = scheduler.runJobs(jobs, args.n_procs, args.max_heavy_procs)
+    finally:
+        renderFailures = render.stop()
+    results = scheduler.addRenderFailures(results, renderFailures)
+    failed = scheduler.reportFailures(results)
+
+    # Cleanup of what this run left behind (failed acquisitions), other participant runs
+    # may still be working in the same qc_data
+    for (job, _, _) in results:
+        pipeline.removeAcquisitionData(job)
+
+    if failed:
+        sys.exit(1)
 
 # running group level
 elif args.analysis_level == "group":
+    from diffqc import group
+    from diffqc import statsindex
+    from diffqc import profiler
+
+    # get figure names and number of figures per subject, one scan of qc_figures
+    figFolder = os.path.join(args.output_dir, 'qc_figures')
+    figures = group.scanFigures(figFolder)
 
-    # get figure names and number of figures per subject
     myList = []
 
     for subject_label in subjects_to_analyze:
-        for image_file in glob(os.path.join(args.output_dir, 'qc_figures', "sub-%s*"%subject_label, "*.png")):
-            myList.extend([os.path.basename(image_file)[0:-4]])
+        for folder in figures:
+            if bidsindex.parseEntities(folder)[0].get('sub') == subject_label:
+                myList.extend([name[0:-4] for name in figures[folder]])
 
     imgSet = set(myList)
 
+    thumbFolder = os.path.join(args.output_dir, 'qc_thumbnails')
+    group.createThumbnails(figFolder, thumbFolder, figures, args.n_procs)
+
     wp = {}
     wp['filePath'] = os.path.join(args.output_dir, "_quality.html")
     wp['subjects'] = subjects_to_analyze
-    wp['subFolders'] = [os.path.split(subF)[-1][4:] for subF in glob(os.path.join(args.output_dir,'qc_figures',"sub-*")) ]
-    wp['figFolder'] = os.path.join(args.output_dir, 'qc_figures')
+    wp['subFolders'] = list(figures.keys())
+    wp['figures'] = figures
+    wp['figFolder'] = figFolder
+    wp['thumbFolder'] = thumbFolder
+    wp['pageSize'] = args.report_page_size
     wp['maxImg'] = len(imgSet)
     wp['maxList'] = list(sorted(imgSet))
 
     group.createWebPage(wp)
 
-    # create group stats table
-    df = pd.DataFrame([])
-    for subj_stats in glob(os.path.join(args.output_dir, 'qc_stats', 'sub-*', "*.tsv")):
-        df = df.append(pd.read_csv(subj_stats, sep="\t"))
+    # create group stats table from the stats index, only new or changed files are read
+    statsindex.sync(args.output_dir)
+    df = statsindex.table(args.output_dir)
 
     out_file = os.path.join(args.output_dir, "qc_stats_all.tsv")
     df.to_csv(out_file, sep="\t", index=False)
+
+    # per-stage percentiles over all acquisitions run with --profile
+    profiler.cohortPercentiles(args.output_dir)
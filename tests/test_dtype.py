@@ -0,0 +1,89 @@
+import os
+import sys
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import synthetic
+
+# the participant stats of a synthetic dataset agree between the float32 and the float64 data
+# path; tensors are fitted in-process, dwidenoise is the stand-in of the benchmarks
+pytest.importorskip('dipy.segment.mask')
+
+RTOL = 1e-5
+ATOL = 1e-6
+
+@pytest.fixture
+def standins(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = os.path.join(root, 'benchmarks', 'mrtrix_standins.py')
+    for tool in ('dwidenoise', 'dwi2tensor', 'tensor2metric', 'dwiextract'):
+        os.symlink(script, str(bin_dir / tool))
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+def addArtifacts(dwi_file, slices=((5, 6), (20, 9), (28, 7), (45, 8), (55, 10))):
+    # signal spikes in single slices (volume, slice), so that there are outliers to detect
+    img = nib.load(dwi_file)
+    data = np.asarray(img.dataobj)
+    for (v, z) in slices:
+        if v < data.shape[3]:
+            data[:, :, z, v] *= 4
+    nib.save(nib.Nifti1Image(data, img.affine, img.header), dwi_file)
+
+def participantStats(bids_dir, output_dir, dtype, monkeypatch):
+    from diffqc import bidsindex
+    from diffqc import pipeline
+    from diffqc import tensor
+
+    # dtypes of the data going into the tensor fit and of the predicted signal coming out
+    fitDtypes = []
+    fitTensor = tensor.fitTensor
+    def recordedFit(data, *args, **kwargs):
+        fit = fitTensor(data, *args, **kwargs)
+        fitDtypes.append((data.dtype, fit['predicted'].dtype))
+        return fit
+    monkeypatch.setattr(tensor, 'fitTensor', recordedFit)
+
+    bids = bidsindex.load(bids_dir)
+    for job in pipeline.acquisitionJobs(bids, output_dir, bids.subjects(), tensor_backend='numpy',
+                                        dtype=dtype, stage_threads=1):
+        pipeline.processAcquisition(job)
+    stats = {}
+    for folder in sorted(os.listdir(os.path.join(output_dir, 'qc_stats'))):
+        stats_file = os.path.join(output_dir, 'qc_stats', folder, 'stats.tsv')
+        if os.path.isfile(stats_file):
+            stats[folder] = pd.read_csv(stats_file, sep="\t")
+
+    # the whole data path runs in dtype
+    assert fitDtypes
+    assert all(d == (np.dtype(dtype), np.dtype(dtype)) for d in fitDtypes)
+    return stats
+
+@pytest.mark.parametrize('shells', [(1000,), (1000, 2000)])
+def test_float32_matches_float64(tmp_path, standins, monkeypatch, shells):
+    bids_dir = str(tmp_path / 'bids')
+    for dwi_file in synthetic.createDataset(bids_dir, 1, matrix=(24, 24, 16), shells=shells, dirs=30, b0s=2,
+                                            t1=False):
+        addArtifacts(dwi_file)
+
+    single = participantStats(bids_dir, str(tmp_path / 'float32'), 'float32', monkeypatch)
+    double = participantStats(bids_dir, str(tmp_path / 'float64'), 'float64', monkeypatch)
+
+    # one table per acquisition and per shell of multi-shell data
+    assert sorted(single) == sorted(double)
+    assert len(single) == (1 if len(shells) == 1 else 1 + len(shells))
+    assert all(single[folder][['signal_outlier', 'residual_outlier']].values.max() > 0 for folder in single)
+    for folder in single:
+        assert list(single[folder].columns) == list(double[folder].columns)
+        for column in single[folder].columns:
+            if pd.api.types.is_numeric_dtype(single[folder][column]):
+                np.testing.assert_allclose(single[folder][column], double[folder][column],
+                                           rtol=RTOL, atol=ATOL, err_msg=folder + ' ' + column)
+            else:
+                assert single[folder][column].equals(double[folder][column])